@@ -0,0 +1,57 @@
+from panda3d.core import NodePath
+
+
+class AssetRegistry:
+    """
+    Loads (or builds) each model once per process and hands out instances of it, and shares collision shapes between
+    every body that needs the same one. Instances share the model's nodes, so anything that should differ between them
+    (position, color, visibility) has to be set on the instance itself; changes every instance should share go in
+    `prepare`.
+    Shared shapes must be left alone once they are made, and bodies using them must not be scaled, since Bullet scales
+    a body's shapes along with it.
+    """
+
+    def __init__(self):
+        self.models = {}
+        self.geometry_nodes = {}
+        self.shapes = {}
+
+    def model(self, loader, name, prepare=None):
+        """
+        Returns a new NodePath with the named model instanced under it. The first time, the model is loaded with
+        `loader` and passed to `prepare`, if given.
+        """
+        if name not in self.models:
+            model = loader.load_model(name)
+            if prepare:
+                prepare(model)
+            self.models[name] = model
+        instance = NodePath(name)
+        self.models[name].instance_to(instance)
+        return instance
+
+    def geometry(self, key, make):
+        """
+        Like `model`, but for geometry built in code: `make` is called to build the NodePath to share the first time.
+        """
+        if key not in self.geometry_nodes:
+            self.geometry_nodes[key] = make()
+        instance = NodePath(self.geometry_nodes[key].get_name())
+        self.geometry_nodes[key].instance_to(instance)
+        return instance
+
+    def shape(self, key, make):
+        """
+        Returns the collision shape for `key`, calling `make` to build it the first time.
+        """
+        if key not in self.shapes:
+            self.shapes[key] = make()
+        return self.shapes[key]
+
+    def clear(self):
+        self.models = {}
+        self.geometry_nodes = {}
+        self.shapes = {}
+
+
+assets = AssetRegistry()
@@ -0,0 +1,118 @@
+from panda3d.bullet import BulletRigidBodyNode
+from panda3d.core import NodePath
+
+from .constants import Collision
+from .geom import GeomBuilder, make_geom_node, pack_vertices
+
+import math
+
+
+class StaticGeometry:
+    """
+    Collects the visible geometry of immovable objects and merges it into one GeomNode per spatial cell, so a map is
+    drawn in a handful of batches instead of one per block. Colors are per-vertex, so objects of every color share a
+    batch. Cells keep the batches small enough to be culled.
+    """
+
+    CELL_SIZE = 64.0
+
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.builders = {}
+
+    def cell(self, pos):
+        return (int(math.floor(pos[0] / self.cell_size)), int(math.floor(pos[1] / self.cell_size)))
+
+    def add(self, obj, pos):
+        """
+        Adds an object's geometry (in world coordinates, via its `build_geometry` method) to the cell containing `pos`.
+        """
+        cell = self.cell(pos)
+        if cell not in self.builders:
+            self.builders[cell] = GeomBuilder('static-{}-{}'.format(*cell))
+        obj.build_geometry(self.builders[cell])
+
+    def bake(self):
+        """
+        Returns the pending geometry of each cell as a (name, vertices, indices) tuple, ready for `attach_geometry`,
+        and clears it.
+        """
+        return list(self.bake_cells())
+
+    def bake_cells(self):
+        """
+        Like `bake`, but a generator that bakes one cell at a time.
+        """
+        builders, self.builders = self.builders, {}
+        for cell in sorted(builders):
+            rows, indices = builders[cell].arrays()
+            yield builders[cell].name, pack_vertices(rows), indices
+
+    def flush(self, parent):
+        """
+        Attaches a GeomNode for each cell with pending geometry under `parent`.
+        """
+        attach_geometry(parent, self.bake())
+
+
+class StaticCollision:
+    """
+    Collects the collision shapes of immovable objects into a single compound body, so Bullet's broadphase and ray/sweep
+    tests see one static body instead of one per block. Bullet keeps an AABB tree over the children of a compound
+    shape, and each child stays convex, so collisions behave exactly as they did with separate bodies.
+    """
+
+    def __init__(self):
+        self.shapes = []
+
+    def add(self, shape, transform):
+        self.shapes.append((shape, transform))
+
+    def build(self):
+        """
+        Returns a body for everything added since the last flush (or None if nothing was), and clears it.
+        """
+        if not self.shapes:
+            return None
+        body = BulletRigidBodyNode('static-collision')
+        for shape, transform in self.shapes:
+            body.add_shape(shape, transform)
+        body.set_into_collide_mask(Collision.SOLID)
+        body.set_restitution(0.0)
+        self.shapes = []
+        return body
+
+    def bake(self):
+        """
+        Like `build`, but returns the body encoded as a BAM stream for `attach_collision`, or None.
+        """
+        body = self.build()
+        return NodePath(body).encode_to_bam_stream() if body else None
+
+    def flush(self, world):
+        """
+        Attaches a body for everything added since the last flush.
+        """
+        body = self.build()
+        if body:
+            attach_body(world, body)
+
+
+def attach_geometry(parent, baked):
+    """
+    Attaches geometry from `StaticGeometry.bake` under `parent`.
+    """
+    for name, vertices, indices in baked:
+        parent.attach_new_node(make_geom_node(name, vertices, indices))
+
+
+def attach_collision(world, baked):
+    """
+    Attaches a body from `StaticCollision.bake` to the world.
+    """
+    attach_body(world, NodePath.decode_from_bam_stream(baked).node())
+
+
+def attach_body(world, body):
+    world.physics.attach(body)
+    world.node.attach_new_node(body)
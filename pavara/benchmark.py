@@ -0,0 +1,79 @@
+from panda3d.core import loadPrcFileData
+
+from .log import configure_logging
+from .mapcache import MapCache
+from .maps import load_map
+from .world import World
+
+import argparse
+import collections
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+
+logger = logging.getLogger('pavara.benchmark')
+
+
+def best_time(func, repeat):
+    """
+    Returns the fastest of `repeat` runs of `func`, in seconds.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmark_map(filename, repeat=5):
+    """
+    Times loading a map from its XML (with and without batching), compiling it into an empty cache, and loading it
+    from the compiled cache, both for drawing and headless (as servers do). Returns a dict of timings in seconds, along with a count of the map's objects by class.
+    """
+    directory = tempfile.mkdtemp(prefix='pavara-benchmark-')
+    try:
+        def cold():
+            shutil.rmtree(directory, ignore_errors=True)
+            MapCache(directory).get(filename).load(World())
+
+        world = World()
+        load_map(filename, world, combine_static=True)
+        return {
+            'xml': best_time(lambda: load_map(filename, World(batching=False)), repeat),
+            'batched': best_time(lambda: load_map(filename, World(), combine_static=True), repeat),
+            'cold': best_time(cold, repeat),
+            'warm': best_time(lambda: MapCache(directory).get(filename).load(World()), repeat),
+            'headless': best_time(lambda: MapCache(directory).get(filename).load(World(headless=True)), repeat),
+            'objects': collections.Counter(type(obj).__name__ for obj in world.objects.values()),
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    configure_logging()
+    loadPrcFileData('', 'window-type none')
+
+    parser = argparse.ArgumentParser(description='Benchmark loading Pavara maps')
+    parser.add_argument('-n', '--repeat', type=int, default=5)
+    parser.add_argument('paths', nargs='*', default=['maps'])
+    args = parser.parse_args()
+
+    totals = collections.Counter()
+    for path in args.paths:
+        if os.path.isdir(path):
+            filenames = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.xml'))
+        else:
+            filenames = [path]
+        for filename in filenames:
+            result = benchmark_map(filename, args.repeat)
+            objects = result.pop('objects')
+            totals.update(result)
+            logger.info('%s: %s (%s)', filename, ', '.join('{} {:.1f}ms'.format(k, v * 1000.0) for k, v in result.items()),
+                        ', '.join('{} {}'.format(count, name) for name, count in sorted(objects.items())))
+    logger.info('total: %s', ', '.join('{} {:.1f}ms'.format(k, v * 1000.0) for k, v in totals.items()))
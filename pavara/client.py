@@ -1,13 +1,20 @@
 from direct.showbase.ShowBase import ShowBase
 from panda3d.core import AntialiasAttrib, WindowProperties, loadPrcFile, loadPrcFileData
 
+from .constants import TIMESTEP
+from .interpolation import Interpolator
+from .loading import SlicedLoader
 from .log import configure_logging
-from .network import MsgpackProtocol
+from .mapcache import DEFAULT_CACHE_DIR, MapCache, MapDownload
+from .network import DatagramProtocol, MsgpackProtocol
 from .objects import GameObject
+from .player import Player
+from .snapshot import SnapshotDecoder
 from .world import World
 
 import argparse
 import asyncio
+import collections
 import logging
 import math
 import os
@@ -27,11 +34,33 @@ class Client (ShowBase):
 
         self.loop = asyncio.get_event_loop()
         self.protocol = None
+        self.datagrams = None
+        self.datagrams_ready = False
         self.pid = None
+        self.token = None
+        self.maps = MapCache(opts.map_cache)
+        self.maps.scan('maps')
+        # While the map is downloading or loading, the 'loaded' arguments and any messages that need the world are held
+        # here.
+        self.download = None
+        self.loading = None
+        self.pending = None
+        self.deferred = []
         self.world = None
+        self.snapshots = None
+        self.interpolator = None
         self.player = None
         self.overhead = True
 
+        # Input is sampled and sent once per tick, and applied to our own player immediately.
+        self.motion = set()
+        self.center = False
+        self.mouse_x = 0.0
+        self.mouse_y = 0.0
+        self.input_seq = 0
+        self.next_input = None
+        self.predictions = collections.deque()
+
         self.last_ping = None
         self.latency = 0
 
@@ -70,8 +99,8 @@ class Client (ShowBase):
         self.a = 0.0
 
     def load(self):
-        with open('maps/icebox-classic.xml', 'r') as f:
-            self.protocol.send('load', xml=f.read())
+        compiled = self.maps.get('maps/icebox-classic.xml')
+        self.protocol.send('load', map=compiled.hash)
 
     def ready(self):
         self.protocol.send('ready')
@@ -83,7 +112,15 @@ class Client (ShowBase):
         self.protocol.send('explode')
 
     def input(self, cmd, pressed):
-        self.protocol.send('input', input=cmd, pressed=pressed)
+        if cmd == 'center':
+            if pressed:
+                self.center = True
+                if self.player:
+                    self.player.input('center', True)
+        elif pressed:
+            self.motion.add(cmd)
+        else:
+            self.motion.discard(cmd)
 
     def fire(self):
         self.protocol.send('fire')
@@ -105,17 +142,74 @@ class Client (ShowBase):
         mw = self.mouseWatcherNode
         if mw.has_mouse():
             x, y = mw.get_mouse_x(), mw.get_mouse_y()
-            self.protocol.send('mouse', x=x, y=y)
+            if (x or y) and self.player:
+                # Accumulated until the next input frame, but applied to our own head right away.
+                self.mouse_x += x
+                self.mouse_y += y
+                self.player.mouse(x, y)
             props = self.win.get_properties()
             self.win.move_pointer(0, int(props.get_x_size() / 2), int(props.get_y_size() / 2))
         return task.cont
 
+    def send_input(self, now):
+        """
+        Sends an input frame for every tick that has elapsed, predicting our own player's movement for each.
+        """
+        if self.next_input is None or now - self.next_input > 4 * TIMESTEP:
+            self.next_input = now
+        while self.next_input <= now:
+            self.next_input += TIMESTEP
+            self.input_seq += 1
+            bits = Player.input_bits(self.motion)
+            if self.center:
+                bits |= Player.INPUT_BITS['center']
+            self.protocol.send('input', frame=(self.input_seq, bits, self.mouse_x, self.mouse_y))
+            self.player.input_seq = self.input_seq
+            self.player.set_motion(bits)
+            self.player.update(self.world, TIMESTEP)
+            self.predictions.append((self.input_seq, bits))
+            self.center = False
+            self.mouse_x = 0.0
+            self.mouse_y = 0.0
+
+    def reconcile(self, state, movement):
+        """
+        Resets our own player to the server's state, then replays the inputs the server hadn't applied yet.
+        """
+        while self.predictions and self.predictions[0][0] <= movement['seq']:
+            self.predictions.popleft()
+        self.player.set_state(state)
+        self.player.set_movement(movement)
+        for seq, bits in self.predictions:
+            self.player.set_motion(bits)
+            self.player.update(self.world, TIMESTEP)
+        if self.predictions:
+            self.player.input_seq = self.predictions[-1][0]
+        # The head follows our mouse, not the (older) server state.
+        self.player.reposition_head()
+
     def ping_loop(self):
         if self.protocol:
             self.last_ping = self.loop.time()
             self.protocol.send('ping')
+        if self.datagrams and not self.datagrams_ready:
+            # Keep saying hello until the server acknowledges our datagram channel over TCP.
+            self.datagrams.send('hello', token=self.token)
         self.loop.call_later(1.0, self.ping_loop)
 
+    def open_datagrams(self):
+        coro = self.loop.create_datagram_endpoint(lambda: DatagramProtocol(self, loss=self.opts.loss),
+                                                  remote_addr=(self.opts.addr, self.opts.port))
+        task = self.loop.create_task(coro)
+        task.add_done_callback(self.datagrams_opened)
+
+    def datagrams_opened(self, task):
+        if task.exception():
+            logger.debug('Could not open datagram channel, state will be sent over TCP: %s', task.exception())
+            return
+        _, self.datagrams = task.result()
+        self.datagrams.send('hello', token=self.token)
+
     def render_loop(self):
         next_call = self.loop.time() + self.throttle
         if self.overhead:
@@ -124,6 +218,10 @@ class Client (ShowBase):
             y = math.sin(self.a) * 100.0
             self.camera.set_pos(x, y, 150)
             self.camera.look_at(0, 0, 0)
+        if self.player and self.protocol:
+            self.send_input(self.loop.time())
+        if self.interpolator:
+            self.interpolator.update(self.world, self.loop.time())
         self.taskMgr.step()
         if self.world and self.opts.debug:
             # This is just so the BulletWorld draws the debug node.
@@ -146,7 +244,7 @@ class Client (ShowBase):
     def connected(self, proto):
         logger.debug('Connected to %s:%s', proto.address, proto.port)
         self.protocol = proto
-        self.protocol.send('join', name=self.opts.name)
+        self.protocol.send('join', name=self.opts.name, room=self.opts.room)
         self.ping_loop()
 
     def disconnected(self, proto):
@@ -155,43 +253,165 @@ class Client (ShowBase):
 
     def handle(self, proto, cmd, **args):
         # logger.debug('Message received: %s', cmd)
+        if (self.download or self.loading) and cmd in ('attached', 'removed', 'started'):
+            self.deferred.append((cmd, args))
+            return
         func = getattr(self, 'handle_{}'.format(cmd), None)
         if func:
             func(**args)
         else:
             logger.error('Unknown command: %s', cmd)
 
+    # DatagramProtocol delegate
+
+    def datagram_received(self, channel, addr, cmd, **args):
+        self.handle(self.protocol, cmd, **args)
+
+    def handle_token(self, **args):
+        self.token = args['token']
+
     def handle_self(self, **args):
         self.pid = args['pid']
+        self.open_datagrams()
+
+    def handle_welcome(self, **args):
+        logger.debug('Receiving state over datagram channel')
+        self.datagrams_ready = True
 
     def handle_joined(self, **args):
         pass
 
-    def handle_started(self, **args):
-        self.player = self.world.objects[self.pid]
+    def claim_player(self):
+        """
+        Takes control of our own player, and looks through its eyes, once it is in the world. Players that get ready
+        after the match has started never hear 'started', so this happens whenever our pid shows up.
+        """
+        player = self.world.objects.get(self.pid) if self.world else None
+        if player is None or player is self.player:
+            return
+        self.player = player
         self.player.set_camera(self.camera)
         self.overhead = False
 
+    def handle_started(self, **args):
+        self.claim_player()
+
     def handle_attached(self, **args):
         for data in args['objects']:
             self.world.attach(GameObject.deserialize(data))
         if 'state' in args:
-            self.world.set_state(args['state'], fluid=False)
+            self.snapshots.seed(args['state'])
+            self.world.set_state(args['state'])
+            for world_id, state in args['state'].items():
+                self.interpolator.reset(world_id, state)
+        self.claim_player()
 
     def handle_removed(self, **args):
         for world_id in args['world_ids']:
+            self.snapshots.remove(world_id)
+            self.interpolator.remove(world_id)
             self.world.remove(world_id)
 
     def handle_state(self, **args):
         # logger.debug('Got state for frame %s', args['frame'])
-        self.world.set_state(args['state'])
+        if not self.snapshots:
+            # State can arrive over the datagram channel before the world is loaded.
+            return
+        states = self.snapshots.apply(args['frame'], args['state'])
+        if states is None:
+            return
+        if self.player and self.pid in states:
+            # Our own player is predicted locally rather than interpolated.
+            self.reconcile(states.pop(self.pid), args['movement'])
+        self.interpolator.push(args['frame'], states, self.loop.time())
+        if self.datagrams_ready:
+            self.datagrams.send('ack', frame=args['frame'])
+        else:
+            self.protocol.send('ack', frame=args['frame'])
+
+    def handle_loading(self, **args):
+        logger.debug('Server loading map %s: %s %d/%d', args['map'], args['stage'], args['done'], args['total'])
 
     def handle_loaded(self, **args):
-        self.world = World(loader=self.loader, camera=self.cam, debug=self.opts.debug)
-        self.world.deserialize(args['objects'])
-        if 'state' in args:
-            self.world.set_state(args['state'], fluid=False)
+        if self.loading:
+            self.loading.cancel()
+        self.pending = args
+        self.load_world(self.maps.find_steps(args['map']))
+
+    def load_world(self, steps):
+        """
+        Loads the world a slice at a time from a generator that returns its CompiledMap, attaching objects to the
+        scene as they are created. Messages that need the finished world are deferred until it is ready.
+        """
+        self.loading = SlicedLoader(self.loop, self.load_steps(steps), finished=self.world_loaded,
+                                    failed=self.load_failed)
+        self.loading.start()
+
+    def load_steps(self, steps):
+        args = self.pending
+        compiled = yield from steps
+        if compiled is None:
+            return False
+        if self.world:
+            if self.player:
+                # Our player goes with the old world, so take the camera back first.
+                self.player = None
+                self.camera.reparent_to(self.render)
+                self.overhead = True
+            # Some objects (like the sky) hang things off the camera rather than the world's node.
+            for obj in self.world.objects.values():
+                obj.removed(self.world)
+            self.world.node.remove_node()
+        # Objects are created from what the server sends, never spawned here, so there is nothing to pool.
+        self.world = World(loader=self.loader, camera=self.cam, debug=self.opts.debug, pool_size=0)
         self.world.node.reparent_to(self.render)
+        yield from compiled.load_steps(self.world)
+        for world_id in args['removed']:
+            self.world.remove(world_id)
+        for data in args['objects']:
+            self.world.attach(GameObject.deserialize(data))
+        self.snapshots = SnapshotDecoder(args['frame'], args['state'])
+        self.interpolator = Interpolator(TIMESTEP)
+        self.world.set_state(args['state'])
+        for world_id, state in args['state'].items():
+            if state:
+                self.interpolator.reset(world_id, state)
+        self.claim_player()
+        return True
+
+    def world_loaded(self, loaded):
+        self.loading = None
+        if not loaded:
+            logger.debug('Downloading map %s', self.pending['map'])
+            self.download = MapDownload(self.pending['map'], self.protocol.send)
+            self.download.start()
+            return
+        deferred, self.deferred = self.deferred, []
+        for cmd, args in deferred:
+            self.handle(self.protocol, cmd, **args)
+
+    def load_failed(self, error):
+        self.loading = None
+        self.deferred = []
+
+    def handle_map_request(self, **args):
+        chunk = self.maps.chunk(args['map'], args['index'])
+        if chunk:
+            count, data = chunk
+            self.protocol.send('map_chunk', map=args['map'], index=args['index'], count=count, data=data)
+
+    def handle_map_chunk(self, **args):
+        if not self.download or self.download.digest != args['map']:
+            return
+        try:
+            xml = self.download.received(args['index'], args['count'], args['data'])
+        except ValueError as e:
+            logger.error('Could not download map: %s', e)
+            self.download = None
+            return
+        if xml:
+            self.download = None
+            self.load_world(self.maps.get_steps(xml))
 
     def handle_pong(self, **args):
         self.latency = self.loop.time() - self.last_ping
@@ -211,9 +431,12 @@ if __name__ == '__main__':
     parser.add_argument('-a', '--addr', default='127.0.0.1')
     parser.add_argument('-p', '--port', type=int, default=19567)
     parser.add_argument('-n', '--name', default='unnamed')
+    parser.add_argument('-r', '--room', default=None)
     parser.add_argument('-l', '--local', action='store_true', default=False)
     parser.add_argument('-d', '--debug', action='store_true', default=False)
     parser.add_argument('-t', '--throttle', type=float, default=100.0)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--map-cache', default=DEFAULT_CACHE_DIR)
 
     opts = parser.parse_args()
 
@@ -7,6 +7,9 @@ DEFAULT_SKY_COLOR = LColor(0, 0, 0.15, 1)
 DEFAULT_HORIZON_COLOR = LColor(0, 0, 0.8, 1)
 DEFAULT_HORIZON_SCALE = 0.05
 
+# Seconds per server tick.
+TIMESTEP = 1.0 / 30.0
+
 
 class Collision:
     NONE = BitMask32.all_off()
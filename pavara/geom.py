@@ -1,10 +1,38 @@
-from panda3d.core import (
-    Geom, GeomNode, GeomTriangles, GeomVertexData, GeomVertexFormat, GeomVertexWriter, LRotationf, LVector3f, Point3,
-    Vec3)
+from panda3d.core import Geom, GeomNode, GeomTriangles, GeomVertexData, GeomVertexFormat, GeomVertexWriter, Point3, Vec3
+import numpy
 
 from math import cos, pi, sin
 
 
+# Matches the single interleaved array of GeomVertexFormat.get_v3n3cpt2(), for writing vertex data in bulk.
+VERTEX_DTYPE = numpy.dtype({
+    'names': ['vertex', 'normal', 'color', 'texcoord'],
+    'formats': [('<f4', 3), ('<f4', 3), '<u4', ('<f4', 2)],
+    'offsets': [0, 12, 24, 28],
+    'itemsize': 36,
+})
+
+# Corners of a unit block, and the corners of each of its faces: XY, XZ and YZ pairs.
+BLOCK_CORNERS = numpy.array((
+    (-1, +1, +1),
+    (-1, -1, +1),
+    (+1, -1, +1),
+    (+1, +1, +1),
+    (+1, +1, -1),
+    (+1, -1, -1),
+    (-1, -1, -1),
+    (-1, +1, -1),
+), dtype=numpy.float64)
+BLOCK_FACES = numpy.array(((0, 1, 2, 3), (4, 5, 6, 7), (0, 3, 4, 7), (6, 5, 2, 1), (5, 4, 3, 2), (7, 6, 1, 0)))
+
+# Corners of each face of a ramp (see `GeomBuilder.add_ramps`): top and bottom, back and front, left and right.
+RAMP_FACES = numpy.array(((0, 1, 2, 3), (7, 6, 5, 4), (0, 3, 4, 5), (6, 7, 2, 1), (0, 5, 6, 1), (7, 4, 3, 2)))
+
+# Corners of each face of a wedge (see `GeomBuilder.add_wedges`): the slope, bottom and back, then the two sides.
+WEDGE_QUADS = numpy.array(((0, 1, 2, 3), (5, 4, 2, 1), (0, 3, 4, 5)))
+WEDGE_SIDES = numpy.array(((5, 1, 0), (4, 3, 2)))
+
+
 class InvalidPrimitive (Exception):
     pass
 
@@ -19,8 +47,8 @@ class VertexDataWriter (object):
         self.texcoord = GeomVertexWriter(vdata, 'texcoord')
 
     def add_vertex(self, point, normal, color, texcoord):
-        self.vertex.add_data3f(point)
-        self.normal.add_data3f(normal)
+        self.vertex.add_data3f(*point)
+        self.normal.add_data3f(*normal)
         self.color.add_data4f(*color)
         self.texcoord.add_data2f(*texcoord)
         self.count += 1
@@ -45,32 +73,56 @@ class Polygon (object):
 
 
 class GeomBuilder(object):
-
-    def __init__(self, name='tris'):
+    """
+    Builds indexed triangle geometry. Blocks, ramps and wedges added one at a time are queued and generated together as
+    NumPy arrays when the Geom is built; `add_blocks`, `add_ramps` and `add_wedges` take arrays of primitives directly. Vertices with the
+    same position, normal and color are shared, and the vertex and index data are written in bulk, or row by row with
+    `bulk=False`.
+    """
+
+    def __init__(self, name='tris', usage=Geom.UHStatic, bulk=True):
         self.name = name
-        self.vdata = GeomVertexData(name, GeomVertexFormat.get_v3n3cpt2(), Geom.UHDynamic)
-        self.writer = VertexDataWriter(self.vdata)
-        self.tris = GeomTriangles(Geom.UHDynamic)
+        self.usage = usage
+        self.bulk = bulk
+        # (x, y, z, nx, ny, nz, r, g, b, a) rows and triangle indices from single polygons.
+        self.rows = []
+        self.triangles = []
+        # (rows, indices) arrays from batches of polygons.
+        self.chunks = []
+        self.queued = {'blocks': [], 'ramps': [], 'wedges': []}
 
     def _commit_polygon(self, poly, color):
         """
         Transmutes colors and vertices for tris and quads into visible geometry.
         """
-        point_id = self.writer.count
+        if len(poly.points) not in (3, 4):
+            raise InvalidPrimitive
+        normal = poly.get_normal()
+        first = len(self.rows)
         for p in poly.points:
-            self.writer.add_vertex(p, poly.get_normal(), color, (0.0, 1.0))
+            self.rows.append((p[0], p[1], p[2], normal[0], normal[1], normal[2], color[0], color[1], color[2],
+                              color[3]))
         if len(poly.points) == 3:
-            self.tris.add_consecutive_vertices(point_id, 3)
-            self.tris.close_primitive()
-        elif len(poly.points) == 4:
-            self.tris.add_vertex(point_id)
-            self.tris.add_vertex(point_id + 1)
-            self.tris.add_vertex(point_id + 3)
-            self.tris.close_primitive()
-            self.tris.add_consecutive_vertices(point_id + 1, 3)
-            self.tris.close_primitive()
+            self.triangles.extend((first, first + 1, first + 2))
         else:
+            self.triangles.extend((first, first + 1, first + 3, first + 1, first + 2, first + 3))
+
+    def _commit_polygons(self, points, colors):
+        """
+        Array version of `_commit_polygon`, for an (n, 3 or 4, 3) array of polygons and an (n, 4) array of colors.
+        """
+        count, sides = points.shape[:2]
+        if sides not in (3, 4):
             raise InvalidPrimitive
+        if not count:
+            return
+        rows = numpy.empty((count, sides, 10), dtype=numpy.float32)
+        rows[:, :, 0:3] = points
+        rows[:, :, 3:6] = polygon_normals(points)[:, None, :]
+        rows[:, :, 6:10] = colors[:, None, :]
+        corners = (0, 1, 2) if sides == 3 else (0, 1, 3, 1, 2, 3)
+        indices = (numpy.arange(count)[:, None] * sides + corners).ravel()
+        self.chunks.append((rows.reshape(-1, 10), indices))
 
     def add_tri(self, color, points):
         self._commit_polygon(Polygon(points), color)
@@ -94,208 +146,204 @@ class GeomBuilder(object):
         return self
 
     def add_block(self, color, center, size, rot=None):
-        x_shift = size[0] / 2.0
-        y_shift = size[1] / 2.0
-        z_shift = size[2] / 2.0
-        rot = LRotationf(0, 0, 0) if rot is None else rot
-
-        vertices = (
-            Point3(-x_shift, +y_shift, +z_shift),
-            Point3(-x_shift, -y_shift, +z_shift),
-            Point3(+x_shift, -y_shift, +z_shift),
-            Point3(+x_shift, +y_shift, +z_shift),
-            Point3(+x_shift, +y_shift, -z_shift),
-            Point3(+x_shift, -y_shift, -z_shift),
-            Point3(-x_shift, -y_shift, -z_shift),
-            Point3(-x_shift, +y_shift, -z_shift),
-        )
-        vertices = [rot.xform(v) + LVector3f(*center) for v in vertices]
-
-        faces = (
+        self.queued['blocks'].append((color, center, size, None if rot is None else tuple(rot)))
+        return self
+
+    def add_blocks(self, colors, centers, sizes, rotations=None):
+        """
+        Adds `n` blocks at once, given (n, 4) colors, (n, 3) centers and sizes, and optionally (n, 4) rotation
+        quaternions.
+        """
+        centers = numpy.asarray(centers, dtype=numpy.float64).reshape(-1, 3)
+        sizes = numpy.asarray(sizes, dtype=numpy.float64).reshape(-1, 3)
+        vertices = BLOCK_CORNERS * (sizes / 2.0)[:, None, :]
+        if rotations is not None:
+            vertices = numpy.matmul(vertices, quaternion_matrices(rotations))
+        vertices += centers[:, None, :]
+
+        has_size = sizes != 0
+        faces = numpy.stack((
             # XY
-            [vertices[0], vertices[1], vertices[2], vertices[3]],
-            [vertices[4], vertices[5], vertices[6], vertices[7]],
+            has_size[:, 0] & has_size[:, 1],
             # XZ
-            [vertices[0], vertices[3], vertices[4], vertices[7]],
-            [vertices[6], vertices[5], vertices[2], vertices[1]],
+            has_size[:, 0] & has_size[:, 2],
             # YZ
-            [vertices[5], vertices[4], vertices[3], vertices[2]],
-            [vertices[7], vertices[6], vertices[1], vertices[0]],
-        )
-
-        if size[0] and size[1]:
-            self._commit_polygon(Polygon(faces[0]), color)
-            self._commit_polygon(Polygon(faces[1]), color)
-        if size[0] and size[2]:
-            self._commit_polygon(Polygon(faces[2]), color)
-            self._commit_polygon(Polygon(faces[3]), color)
-        if size[1] and size[2]:
-            self._commit_polygon(Polygon(faces[4]), color)
-            self._commit_polygon(Polygon(faces[5]), color)
-
+            has_size[:, 1] & has_size[:, 2],
+        ), axis=1).repeat(2, axis=1)
+        self._commit_faces(vertices, BLOCK_FACES, faces, colors)
         return self
 
     def add_ramp(self, color, base, top, width, thickness, rot=None):
-        midpoint = Point3((top + base) / 2.0)
-        rot = LRotationf(0, 0, 0) if rot is None else rot
-
-        # Temporarily move `base` and `top` to positions relative to a midpoint
-        # at (0, 0, 0).
-        if midpoint != Point3(0, 0, 0):
-            base = Point3(base - (midpoint - Point3(0, 0, 0)))
-            top = Point3(top - (midpoint - Point3(0, 0, 0)))
-        p3 = Point3(top.get_x(), top.get_y(), top.get_z() - thickness)
-        p4 = Point3(base.get_x(), base.get_y(), base.get_z() - thickness)
-
-        # Use three points to calculate an offset vector we can apply to `base`
-        # and `top` in order to find the required vertices.
-        offset = (Point3(top + Vec3(0, 0, -1000)) - base).cross(top - base)
-        offset.normalize()
-        offset *= (width / 2.0)
-
-        vertices = (
-            Point3(top - offset),
-            Point3(base - offset),
-            Point3(base + offset),
-            Point3(top + offset),
-            Point3(p3 + offset),
-            Point3(p3 - offset),
-            Point3(p4 - offset),
-            Point3(p4 + offset),
-        )
-        vertices = [rot.xform(v) + LVector3f(*midpoint) for v in vertices]
-
-        faces = (
+        self.queued['ramps'].append((color, base, top, width, thickness, None if rot is None else tuple(rot)))
+        return self
+
+    def add_ramps(self, colors, bases, tops, widths, thicknesses, rotations=None):
+        """
+        Adds `n` ramps at once, given (n, 4) colors, (n, 3) bases and tops, (n,) widths and thicknesses, and optionally
+        (n, 4) rotation quaternions.
+        """
+        bases = numpy.asarray(bases, dtype=numpy.float64).reshape(-1, 3)
+        tops = numpy.asarray(tops, dtype=numpy.float64).reshape(-1, 3)
+        widths = numpy.asarray(widths, dtype=numpy.float64).reshape(-1)
+        thicknesses = numpy.asarray(thicknesses, dtype=numpy.float64).reshape(-1)
+        midpoints = (tops + bases) / 2.0
+        vertices = ramp_corners(bases, tops, widths, thicknesses)
+        if rotations is not None:
+            vertices = numpy.matmul(vertices, quaternion_matrices(rotations))
+        vertices += midpoints[:, None, :]
+
+        has_width = widths != 0
+        has_thickness = thicknesses != 0
+        # From `base` to the bottom of `top`.
+        span = tops - bases
+        span[:, 2] -= thicknesses
+        has_length = span.any(axis=1)
+        faces = numpy.stack((
             # Top and bottom.
-            [vertices[0], vertices[1], vertices[2], vertices[3]],
-            [vertices[7], vertices[6], vertices[5], vertices[4]],
+            has_width & has_length,
             # Back and front.
-            [vertices[0], vertices[3], vertices[4], vertices[5]],
-            [vertices[6], vertices[7], vertices[2], vertices[1]],
+            has_width & has_thickness,
             # Left and right.
-            [vertices[0], vertices[5], vertices[6], vertices[1]],
-            [vertices[7], vertices[4], vertices[3], vertices[2]],
-        )
-
-        if width and (p3 - base).length():
-            self._commit_polygon(Polygon(faces[0]), color)
-            self._commit_polygon(Polygon(faces[1]), color)
-        if width and thickness:
-            self._commit_polygon(Polygon(faces[2]), color)
-            self._commit_polygon(Polygon(faces[3]), color)
-        if thickness and (p3 - base).length():
-            self._commit_polygon(Polygon(faces[4]), color)
-            self._commit_polygon(Polygon(faces[5]), color)
-
+            has_thickness & has_length,
+        ), axis=1).repeat(2, axis=1)
+        self._commit_faces(vertices, RAMP_FACES, faces, colors)
         return self
 
+    def _commit_faces(self, vertices, template, faces, colors):
+        """
+        Commits the faces of `n` shapes, where `vertices` is (n, corners, 3), `template` lists the corners of each face,
+        and `faces` is an (n, len(template)) mask of which faces to draw.
+        """
+        colors = numpy.asarray(colors, dtype=numpy.float64).reshape(-1, 4)
+        points = vertices[:, template, :][faces]
+        colors = numpy.broadcast_to(colors[:, None, :], faces.shape + (4,))[faces]
+        self._commit_polygons(points, colors)
+
+    def _flush_queued(self):
+        blocks = self.queued['blocks']
+        if blocks:
+            colors, centers, sizes, rotations = zip(*blocks)
+            self.add_blocks(colors, centers, sizes, queued_rotations(rotations))
+        ramps = self.queued['ramps']
+        if ramps:
+            colors, bases, tops, widths, thicknesses, rotations = zip(*ramps)
+            self.add_ramps(colors, bases, tops, widths, thicknesses, queued_rotations(rotations))
+        wedges = self.queued['wedges']
+        if wedges:
+            colors, bases, tops, widths, rotations = zip(*wedges)
+            self.add_wedges(colors, bases, tops, widths, queued_rotations(rotations))
+        self.queued = {'blocks': [], 'ramps': [], 'wedges': []}
+
     def add_wedge(self, color, base, top, width, rot=None):
-        delta_y = top.get_y() - base.get_y()
-        midpoint = Point3((top + base) / 2.0)
-        rot = LRotationf(0, 0, 0) if rot is None else rot
-
-        # Temporarily move `base` and `top` to positions relative to a midpoint
-        # at (0, 0, 0).
-        if midpoint != Point3(0, 0, 0):
-            base = Point3(base - (midpoint - Point3(0, 0, 0)))
-            top = Point3(top - (midpoint - Point3(0, 0, 0)))
-        p3 = Point3(top.get_x(), base.get_y(), top.get_z())
-
-        # Use three points to calculate an offset vector we can apply to `base`
-        # and `top` in order to find the required vertices. Ideally we'd use
-        # `p3` as the third point, but `p3` can potentially be the same as `top`
-        # if delta_y is 0, so we'll just calculate a new point relative to top
-        # that differs in elevation by 1000, because that sure seems unlikely.
-        # The "direction" of that point relative to `top` does depend on whether
-        # `base` or `top` is higher. Honestly, I don't know why that's important
-        # for wedges but not for ramps.
-        if base.get_y() > top.get_y():
-            direction = Vec3(0, 1000, 0)
-        else:
-            direction = Vec3(0, -1000, 0)
-        offset = (Point3(top + direction) - base).cross(top - base)
-        offset.normalize()
-        offset *= (width / 2.0)
-
-        vertices = (
-            Point3(top - offset),
-            Point3(base - offset),
-            Point3(base + offset),
-            Point3(top + offset),
-            Point3(p3 + offset),
-            Point3(p3 - offset),
-        )
-        vertices = [rot.xform(v) + LVector3f(*midpoint) for v in vertices]
-
-        faces = (
+        self.queued['wedges'].append((color, base, top, width, None if rot is None else tuple(rot)))
+        return self
+
+    def add_wedges(self, colors, bases, tops, widths, rotations=None):
+        """
+        Adds `n` wedges at once, given (n, 4) colors, (n, 3) bases and tops, (n,) widths, and optionally (n, 4)
+        rotation quaternions. A wedge rises from `base` to `top`, and is solid down to the height of `base`.
+        """
+        bases = numpy.asarray(bases, dtype=numpy.float64).reshape(-1, 3)
+        tops = numpy.asarray(tops, dtype=numpy.float64).reshape(-1, 3)
+        widths = numpy.asarray(widths, dtype=numpy.float64).reshape(-1)
+        midpoints = (tops + bases) / 2.0
+        vertices = wedge_corners(bases, tops, widths)
+        if rotations is not None:
+            vertices = numpy.matmul(vertices, quaternion_matrices(rotations))
+        vertices += midpoints[:, None, :]
+
+        has_width = widths != 0
+        has_height = tops[:, 2] != bases[:, 2]
+        has_run = (tops[:, 0:2] != bases[:, 0:2]).any(axis=1)
+        quads = numpy.stack((
             # The slope.
-            [vertices[0], vertices[1], vertices[2], vertices[3]],
+            has_width | has_height,
             # The bottom.
-            [vertices[5], vertices[4], vertices[2], vertices[1]],
+            has_width & has_run,
             # The back.
-            [vertices[0], vertices[3], vertices[4], vertices[5]],
-            # The sides.
-            [vertices[5], vertices[1], vertices[0]],
-            [vertices[4], vertices[3], vertices[2]],
-        )
-
-        if width or delta_y:
-            self._commit_polygon(Polygon(faces[0]), color)
-        if width and (p3 - base).length():
-            self._commit_polygon(Polygon(faces[1]), color)
-        if width and delta_y:
-            self._commit_polygon(Polygon(faces[2]), color)
-        if delta_y and (p3 - base).length():
-            self._commit_polygon(Polygon(faces[3]), color)
-            self._commit_polygon(Polygon(faces[4]), color)
-
+            has_width & has_height,
+        ), axis=1)
+        sides = (has_height & has_run)[:, None].repeat(2, axis=1)
+        self._commit_faces(vertices, WEDGE_QUADS, quads, colors)
+        self._commit_faces(vertices, WEDGE_SIDES, sides, colors)
         return self
 
     def add_dome(self, color, center, radius, samples, planes, rot=None):
-        two_pi = pi * 2
-        half_pi = pi / 2
-        azimuths = [(two_pi * i) / samples for i in range(samples + 1)]
-        elevations = [(half_pi * i) / (planes - 1) for i in range(planes)]
-        rot = LRotationf(0, 0, 0) if rot is None else rot
-
-        # Generate polygons for all but the top tier. (Quads)
-        for i in range(0, len(elevations) - 2):
-            for j in range(0, len(azimuths) - 1):
-                x1, y1, z1 = to_cartesian(azimuths[j], elevations[i], radius)
-                x2, y2, z2 = to_cartesian(azimuths[j], elevations[i + 1], radius)
-                x3, y3, z3 = to_cartesian(azimuths[j + 1], elevations[i + 1], radius)
-                x4, y4, z4 = to_cartesian(azimuths[j + 1], elevations[i], radius)
-
-                vertices = (
-                    Point3(x1, y1, z1),
-                    Point3(x2, y2, z2),
-                    Point3(x3, y3, z3),
-                    Point3(x4, y4, z4),
-                )
-                vertices = [rot.xform(v) + LVector3f(*center) for v in vertices]
-
-                self._commit_polygon(Polygon(vertices), color)
-
-        # Generate polygons for the top tier. (Tris)
-        for k in range(0, len(azimuths) - 1):
-            x1, y1, z1 = to_cartesian(azimuths[k], elevations[len(elevations) - 2], radius)
-            x2, y2, z2 = Vec3(0, radius, 0)
-            x3, y3, z3 = to_cartesian(azimuths[k + 1], elevations[len(elevations) - 2], radius)
-
-            vertices = (
-                Point3(x1, y1, z1),
-                Point3(x2, y2, z2),
-                Point3(x3, y3, z3),
-            )
-            vertices = [rot.xform(v) + LVector3f(*center) for v in vertices]
-
-            self._commit_polygon(Polygon(vertices), color)
+        azimuths = numpy.linspace(0.0, pi * 2, samples + 1)
+        elevations = numpy.linspace(0.0, pi / 2, planes)
+        grid = to_cartesian(azimuths[None, :], elevations[:, None], radius)
+
+        # Quads for all but the top tier, then tris for the top tier.
+        quads = numpy.stack((grid[:-2, 1:], grid[1:-1, 1:], grid[1:-1, :-1], grid[:-2, :-1]), axis=2).reshape(-1, 4, 3)
+        ring = grid[-2]
+        apex = numpy.broadcast_to((0.0, 0.0, radius), ring[:-1].shape)
+        tris = numpy.stack((ring[1:], apex, ring[:-1]), axis=1)
+
+        center = numpy.asarray(tuple(center), dtype=numpy.float64)
+        matrix = None if rot is None else quaternion_matrices([tuple(rot)])[0]
+        color = numpy.asarray(color, dtype=numpy.float64).reshape(1, 4)
+        for polygons in (quads, tris):
+            if matrix is not None:
+                polygons = numpy.matmul(polygons, matrix)
+            self._commit_polygons(polygons + center, color.repeat(len(polygons), axis=0))
 
         return self
 
+    def add_billboards(self, colors, centers, sizes):
+        """
+        Adds `n` squares facing the origin, given (n, 4) colors, (n, 3) centers, and (n,) sizes (half the width of each
+        square).
+        """
+        centers = numpy.asarray(centers, dtype=numpy.float64).reshape(-1, 3)
+        sizes = numpy.asarray(sizes, dtype=numpy.float64).reshape(-1, 1)
+        forward = normalize(-centers)
+        right = normalize(cross(forward, numpy.broadcast_to((0.0, 0.0, 1.0), forward.shape)))
+        # Straight up or down, any horizontal direction will do.
+        right[~right.any(axis=1)] = (1.0, 0.0, 0.0)
+        up = cross(right, forward)
+        right *= sizes
+        up *= sizes
+        points = numpy.stack((centers - right - up, centers - right + up, centers + right + up, centers + right - up),
+                             axis=1)
+        colors = numpy.broadcast_to(numpy.asarray(colors, dtype=numpy.float64).reshape(-1, 4), (len(centers), 4))
+        self._commit_polygons(points, colors)
+        return self
+
+    def arrays(self):
+        """
+        Returns the deduplicated (rows, indices) arrays for everything added so far.
+        """
+        self._flush_queued()
+        chunks = list(self.chunks)
+        if self.rows:
+            chunks.insert(0, (numpy.array(self.rows, dtype=numpy.float32), numpy.array(self.triangles)))
+        if not chunks:
+            return numpy.empty((0, 10), dtype=numpy.float32), numpy.empty(0, dtype=numpy.intp)
+        offsets = numpy.cumsum([0] + [len(rows) for rows, _ in chunks[:-1]])
+        rows = numpy.concatenate([rows for rows, _ in chunks])
+        indices = numpy.concatenate([chunk_indices + offset for (_, chunk_indices), offset in zip(chunks, offsets)])
+        # Share identical vertices, keeping them in the order they were first added.
+        keys = numpy.ascontiguousarray(rows).view(numpy.dtype((numpy.void, rows.itemsize * 10))).ravel()
+        _, first, inverse = numpy.unique(keys, return_index=True, return_inverse=True)
+        order = numpy.argsort(first)
+        rank = numpy.empty_like(order)
+        rank[order] = numpy.arange(len(order))
+        return rows[first[order]], rank[inverse.reshape(-1)][indices]
+
     def get_geom(self):
-        geom = Geom(self.vdata)
-        geom.add_primitive(self.tris)
+        rows, indices = self.arrays()
+        if self.bulk:
+            return make_geom(self.name, pack_vertices(rows), indices, self.usage)
+        vdata = GeomVertexData(self.name, GeomVertexFormat.get_v3n3cpt2(), self.usage)
+        tris = GeomTriangles(self.usage)
+        tris.set_index_type(index_type(len(rows))[1])
+        writer = VertexDataWriter(vdata)
+        for row in rows.tolist():
+            writer.add_vertex(row[0:3], row[3:6], row[6:10], (0.0, 1.0))
+        for i in range(0, len(indices), 3):
+            tris.add_vertices(*indices[i:i + 3].tolist())
+        geom = Geom(vdata)
+        geom.add_primitive(tris)
         return geom
 
     def get_geom_node(self):
@@ -304,7 +352,201 @@ class GeomBuilder(object):
         return node
 
 
+def index_type(count):
+    """
+    Returns the (NumPy, Panda3D) index types for a Geom with `count` vertices.
+    """
+    if count > 0xffff:
+        return numpy.uint32, Geom.NT_uint32
+    return numpy.uint16, Geom.NT_uint16
+
+
+def pack_vertices(rows):
+    """
+    Converts (n, 10) vertex rows from `GeomBuilder.arrays` into an array of VERTEX_DTYPE records.
+    """
+    vertices = numpy.zeros(len(rows), dtype=VERTEX_DTYPE)
+    vertices['vertex'] = rows[:, 0:3]
+    vertices['normal'] = rows[:, 3:6]
+    vertices['color'] = pack_colors(rows[:, 6:10])
+    vertices['texcoord'] = (0.0, 1.0)
+    return vertices
+
+
+def make_geom(name, vertices, indices, usage=Geom.UHStatic):
+    """
+    Builds a Geom from an array of VERTEX_DTYPE records and an array of triangle indices, copying each into place in
+    one go.
+    """
+    vdata = GeomVertexData(name, GeomVertexFormat.get_v3n3cpt2(), usage)
+    tris = GeomTriangles(usage)
+    dtype, panda_type = index_type(len(vertices))
+    tris.set_index_type(panda_type)
+    if len(vertices):
+        vdata.unclean_set_num_rows(len(vertices))
+        memoryview(vdata.modify_array(0)).cast('B')[:] = numpy.ascontiguousarray(vertices).view(numpy.uint8)
+        array = tris.modify_vertices()
+        array.unclean_set_num_rows(len(indices))
+        memoryview(array).cast('B')[:] = numpy.ascontiguousarray(indices, dtype=dtype).view(numpy.uint8)
+    geom = Geom(vdata)
+    geom.add_primitive(tris)
+    return geom
+
+
+def make_geom_node(name, vertices, indices, usage=Geom.UHStatic):
+    node = GeomNode(name)
+    node.add_geom(make_geom(name, vertices, indices, usage))
+    return node
+
+
+def pack_colors(colors):
+    """
+    Packs an (n, 4) array of RGBA floats into the uint32 DABC layout Panda3D uses for packed colors.
+    """
+    rgba = numpy.clip(colors.astype(numpy.float64) * 255.0, 0, 255).astype(numpy.uint32)
+    return (rgba[:, 3] << 24) | (rgba[:, 0] << 16) | (rgba[:, 1] << 8) | rgba[:, 2]
+
+
+def queued_rotations(rotations):
+    """
+    Turns a sequence of quaternions or None (no rotation) into an array of quaternions, or None if nothing rotates.
+    """
+    if all(rot is None for rot in rotations):
+        return None
+    return [(1, 0, 0, 0) if rot is None else rot for rot in rotations]
+
+
+def cross(a, b):
+    """
+    Row-wise cross products of two (n, 3) arrays; much cheaper than numpy.cross for small arrays.
+    """
+    return numpy.stack((
+        a[:, 1] * b[:, 2] - a[:, 2] * b[:, 1],
+        a[:, 2] * b[:, 0] - a[:, 0] * b[:, 2],
+        a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0],
+    ), axis=1)
+
+
+def normalize(vectors):
+    """
+    Normalizes an (n, 3) array of vectors, leaving zero-length vectors alone.
+    """
+    lengths = numpy.linalg.norm(vectors, axis=-1, keepdims=True)
+    return numpy.divide(vectors, lengths, out=numpy.zeros_like(vectors), where=lengths != 0)
+
+
+def polygon_normals(points):
+    """
+    Array version of `Polygon.get_normal`, for an (n, sides, 3) array of polygons.
+    """
+    normals = cross(points[:, 0] - points[:, 1], points[:, 1] - points[:, 2])
+    # The first three points only fail to give a normal if some of them are the same. Skip repeated points for those
+    # polygons, as Polygon.get_normal does.
+    degenerate = ~normals.any(axis=1)
+    if degenerate.any():
+        polygons = points[degenerate]
+        same = (polygons[:, :, None, :] == polygons[:, None, :, :]).all(axis=-1)
+        repeated = numpy.tril(same, k=-1).any(axis=2)
+        distinct = numpy.argsort(repeated, axis=1, kind='mergesort')[:, :3]
+        p = numpy.take_along_axis(polygons, distinct[:, :, None], axis=1)
+        fallback = cross(p[:, 0] - p[:, 1], p[:, 1] - p[:, 2])
+        fallback[(~repeated).sum(axis=1) < 3] = (0.0, 0.0, 1.0)
+        normals[degenerate] = fallback
+    return normalize(normals)
+
+
+def ramp_corners(bases, tops, widths, thicknesses):
+    """
+    Returns the (n, 8, 3) corners of `n` ramps, relative to the midpoint of each ramp's `base` and `top`. The first
+    four corners are the top surface, from `top` to `base`.
+    """
+    bases = numpy.asarray(bases, dtype=numpy.float64).reshape(-1, 3)
+    tops = numpy.asarray(tops, dtype=numpy.float64).reshape(-1, 3)
+    midpoints = (tops + bases) / 2.0
+    base = bases - midpoints
+    top = tops - midpoints
+    drop = numpy.zeros_like(top)
+    drop[:, 2] = thicknesses
+    p3 = top - drop
+    p4 = base - drop
+
+    # Use three points to calculate an offset vector we can apply to `base`
+    # and `top` in order to find the required vertices.
+    below = top.copy()
+    below[:, 2] -= 1000.0
+    offset = normalize(cross(below - base, top - base)) * (numpy.asarray(widths) / 2.0).reshape(-1, 1)
+
+    return numpy.stack((
+        top - offset,
+        base - offset,
+        base + offset,
+        top + offset,
+        p3 + offset,
+        p3 - offset,
+        p4 - offset,
+        p4 + offset,
+    ), axis=1)
+
+
+def wedge_corners(bases, tops, widths):
+    """
+    Returns the (n, 6, 3) corners of `n` wedges, relative to the midpoint of each wedge's `base` and `top`. The first
+    four corners are the slope, from `top` to `base`, and the last two are below `top` at the height of `base`.
+    """
+    bases = numpy.asarray(bases, dtype=numpy.float64).reshape(-1, 3)
+    tops = numpy.asarray(tops, dtype=numpy.float64).reshape(-1, 3)
+    midpoints = (tops + bases) / 2.0
+    base = bases - midpoints
+    top = tops - midpoints
+    p3 = top.copy()
+    p3[:, 2] = base[:, 2]
+
+    # Use three points to calculate an offset vector we can apply to `base` and `top` in order to find the required
+    # vertices. `p3` can be the same as `top` if the wedge is flat, so use a point far above or below `top` instead,
+    # on the side that keeps the faces pointing outwards.
+    beyond = top.copy()
+    beyond[:, 2] += numpy.where(base[:, 2] > top[:, 2], 1000.0, -1000.0)
+    offset = normalize(cross(beyond - base, top - base)) * (numpy.asarray(widths) / 2.0).reshape(-1, 1)
+
+    return numpy.stack((
+        top - offset,
+        base - offset,
+        base + offset,
+        top + offset,
+        p3 + offset,
+        p3 - offset,
+    ), axis=1)
+
+
+def quaternion_matrices(quaternions):
+    """
+    Converts an (n, 4) array of (r, i, j, k) quaternions, e.g. from `tuple(LRotationf(h, p, r))`, into (n, 3, 3)
+    matrices that transform row vectors the way `LRotationf.xform` does.
+    """
+    w, x, y, z = numpy.asarray(quaternions, dtype=numpy.float64).reshape(-1, 4).T
+    matrices = numpy.empty((len(w), 3, 3))
+    matrices[:, 0, 0] = 1 - 2 * (y * y + z * z)
+    matrices[:, 0, 1] = 2 * (x * y + w * z)
+    matrices[:, 0, 2] = 2 * (x * z - w * y)
+    matrices[:, 1, 0] = 2 * (x * y - w * z)
+    matrices[:, 1, 1] = 1 - 2 * (x * x + z * z)
+    matrices[:, 1, 2] = 2 * (y * z + w * x)
+    matrices[:, 2, 0] = 2 * (x * z + w * y)
+    matrices[:, 2, 1] = 2 * (y * z - w * x)
+    matrices[:, 2, 2] = 1 - 2 * (x * x + y * y)
+    return matrices
+
+
 def to_cartesian(azimuth, elevation, length):
+    """
+    Works on scalars, returning an (x, y, z) tuple, or on broadcastable arrays, returning an (..., 3) array.
+    """
+    if numpy.ndim(azimuth) or numpy.ndim(elevation):
+        return numpy.stack(numpy.broadcast_arrays(
+            length * numpy.sin(azimuth) * numpy.cos(elevation),
+            -length * numpy.cos(azimuth) * numpy.cos(elevation),
+            length * numpy.sin(elevation),
+        ), axis=-1)
     x = length * sin(azimuth) * cos(elevation)
     y = -length * cos(azimuth) * cos(elevation)
     z = length * sin(elevation)
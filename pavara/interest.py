@@ -0,0 +1,35 @@
+class InterestManager:
+    """
+    Decides which objects each client should hear about on a given frame. Objects near the client's player are
+    relevant every frame, further ones only every few frames, and the player itself along with anything in
+    `World.always_relevant` (e.g. projectiles) every frame.
+    """
+
+    # (radius, frames between updates), nearest first. A radius of None covers everything.
+    BANDS = (
+        (60.0, 1),
+        (150.0, 3),
+        (None, 10),
+    )
+
+    def __init__(self, bands=None):
+        self.bands = bands or self.BANDS
+
+    def relevant(self, world, player, frame):
+        """
+        Returns the set of world ids relevant to the player on this frame, or None if everything is.
+        """
+        if player.world_id not in world.objects:
+            return None
+        # Stagger each client's slower bands so they don't all land on the same frame.
+        frame += hash(player.pid)
+        radius = 0.0
+        for band_radius, rate in self.bands:
+            if frame % rate == 0:
+                if band_radius is None:
+                    return None
+                radius = band_radius
+        world_ids = {obj.world_id for obj, _ in world.find(player.node.get_pos(), radius)}
+        world_ids.update(world.always_relevant)
+        world_ids.add(player.world_id)
+        return world_ids
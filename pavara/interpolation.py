@@ -0,0 +1,91 @@
+from panda3d.core import Vec3
+
+import collections
+
+
+def lerp_angle(a, b, t):
+    # Go the short way around.
+    return a + (((b - a + 180.0) % 360.0) - 180.0) * t
+
+
+def blend(a, b, t):
+    state = {}
+    for field, value in b.items():
+        start = a.get(field, value)
+        if field.endswith('hpr'):
+            state[field] = Vec3(*(lerp_angle(start[i], value[i], t) for i in range(3)))
+        else:
+            state[field] = start + (value - start) * t
+    return state
+
+
+class Interpolator:
+    """
+    Client-side jitter buffer. States are stamped with their server time and each object is rendered `delay` seconds
+    behind the newest server time, interpolating between the two samples around that time. If an object's buffer runs
+    dry it is extrapolated for up to MAX_EXTRAPOLATION seconds, then held at its last state and left idle until a new
+    state arrives.
+    """
+
+    DELAY = 0.1
+    MAX_EXTRAPOLATION = 2.0 / 30.0
+    DRIFT = 0.01  # How quickly the clock offset follows packets that arrive later than the best seen so far.
+
+    def __init__(self, timestep, delay=DELAY):
+        self.timestep = timestep
+        self.delay = delay
+        self.offset = None
+        self.buffers = {}
+        self.idle = {}
+
+    def push(self, frame, states, now):
+        server_time = frame * self.timestep
+        # The offset between server and local time is estimated from the least delayed packets.
+        offset = server_time - now
+        if self.offset is None or offset > self.offset:
+            self.offset = offset
+        else:
+            self.offset += (offset - self.offset) * self.DRIFT
+        for world_id, state in states.items():
+            samples = self.buffers.get(world_id)
+            if samples is None:
+                samples = self.buffers[world_id] = collections.deque()
+                if world_id in self.idle:
+                    # Restart from where the object was left, just ahead of the new state.
+                    samples.append((server_time - self.timestep, self.idle.pop(world_id)))
+            elif server_time <= samples[-1][0]:
+                continue
+            samples.append((server_time, dict(state)))
+
+    def reset(self, world_id, state):
+        """
+        Jumps an object straight to a state, e.g. when it is first attached.
+        """
+        self.buffers.pop(world_id, None)
+        self.idle[world_id] = dict(state)
+
+    def remove(self, world_id):
+        self.buffers.pop(world_id, None)
+        self.idle.pop(world_id, None)
+
+    def update(self, world, now):
+        if self.offset is None:
+            return
+        render_time = now + self.offset - self.delay
+        for world_id, samples in list(self.buffers.items()):
+            obj = world.objects.get(world_id)
+            if obj is None:
+                del self.buffers[world_id]
+                continue
+            while len(samples) >= 3 and samples[1][0] <= render_time:
+                samples.popleft()
+            last_time, last_state = samples[-1]
+            if render_time < samples[0][0]:
+                obj.set_state(samples[0][1])
+            elif render_time < last_time or (len(samples) >= 2 and render_time - last_time <= self.MAX_EXTRAPOLATION):
+                (t0, s0), (t1, s1) = samples[0], samples[1]
+                obj.set_state(blend(s0, s1, (render_time - t0) / (t1 - t0)))
+            else:
+                obj.set_state(last_state)
+                del self.buffers[world_id]
+                self.idle[world_id] = last_state
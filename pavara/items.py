@@ -0,0 +1,203 @@
+from direct.interval.LerpInterval import LerpHprInterval
+from panda3d.bullet import BulletSphereShape
+from panda3d.core import LRotationf, NodePath, Vec3
+
+from .assets import assets
+from .constants import Collision
+from .geom import GeomBuilder
+from .objects import PhysicalObject
+from .player import Player
+
+import random
+
+
+class Trigger (PhysicalObject):
+    """
+    A ghost sphere that only overlaps players. Bullet keeps track of what overlaps it as part of the broadphase, so
+    checking for players nearby doesn't take a query of its own. Triggers with nothing to do rest until a player walks
+    into them.
+    """
+
+    def __init__(self, location, radius, name=None):
+        super().__init__(name=name)
+        self.location = location
+        self.radius = radius
+        self.body.set_into_collide_mask(Collision.PLAYER)
+
+    def setup(self, world):
+        self.body.add_shape(assets.shape(('sphere', self.radius), lambda: BulletSphereShape(self.radius)))
+        self.node.set_pos(self.location)
+
+    def players(self):
+        """
+        Yields (player, distance) for each player overlapping the sphere.
+        """
+        for node in self.body.get_overlapping_nodes():
+            obj = node.get_python_tag('object')
+            if isinstance(obj, Player):
+                distance = (obj.node.get_pos() - self.location).length()
+                if distance <= self.radius:
+                    yield obj, distance
+
+
+class Teleporter (Trigger):
+    """
+    Sends players that come within `active_radius` of it, but no nearer than `dead_radius`, to a teleporter in the
+    `destination` group. Maps put a big one under the middle of the level, with a dead zone covering the playing area,
+    to bring back players who wander off the edge.
+    """
+
+    ACTIVE_RADIUS = 2.0
+
+    def __init__(self, location, group=None, destination=None, active_radius=ACTIVE_RADIUS, dead_radius=0.0,
+                 disorient=True, name=None):
+        super().__init__(location, active_radius, name=name)
+        self.group = group
+        self.destination = destination
+        self.dead_radius = dead_radius
+        self.disorient = disorient
+        # Players that arrived here, and shouldn't be sent on until they have left. Players sent here only count as
+        # arrived once the physics step has caught up and seen them overlap; until then they wait in `arriving`, with
+        # the frame they were sent on.
+        self.arrived = set()
+        self.arriving = {}
+
+    def serialize(self):
+        data = super().serialize()
+        data.update({
+            'location': self.location,
+            'group': self.group,
+            'destination': self.destination,
+            'active_radius': self.radius,
+            'dead_radius': self.dead_radius,
+            'disorient': self.disorient,
+        })
+        return data
+
+    def update(self, world, dt):
+        present = set()
+        for player, distance in self.players():
+            if distance < self.dead_radius:
+                continue
+            present.add(player.world_id)
+            if player.world_id not in self.arrived and player.world_id not in self.arriving and self.destination:
+                self.send(world, player)
+        self.arrived &= present
+        for world_id, frame in list(self.arriving.items()):
+            if world_id in present:
+                self.arrived.add(world_id)
+                del self.arriving[world_id]
+            elif frame < world.frame - 1:
+                # They should have shown up by the step after they were sent, so something else moved them on.
+                del self.arriving[world_id]
+        return False
+
+    def idle(self):
+        return not self.arrived and not self.arriving
+
+    def send(self, world, player):
+        targets = [obj for obj in world.objects.values()
+                   if isinstance(obj, Teleporter) and obj.group == self.destination]
+        if not targets:
+            return
+        target = random.choice(targets)
+        target.arriving[player.world_id] = world.frame
+        world.wake(target)
+        player.teleport(target.location, random.uniform(0.0, 360.0) if self.disorient else None)
+        world.moved(player)
+
+
+class Goody (Trigger):
+    """
+    Gives players that touch it grenades and missiles, then disappears for `respawn` seconds.
+    """
+
+    RADIUS = 1.5
+    SIZE = 0.6
+    COLOR = (1.0, 0.8, 0.0, 1.0)
+
+    def __init__(self, location, grenades=0, missiles=0, respawn=0.0, model=None, spin=None, name=None):
+        super().__init__(location, self.RADIUS, name=name)
+        self.grenades = grenades
+        self.missiles = missiles
+        self.respawn = respawn
+        self.model = model
+        self.spin = spin or Vec3(0, 0, 0)
+        self.available = True
+        self.countdown = 0.0
+        self.display = None
+        self.spinner = None
+
+    def serialize(self):
+        data = super().serialize()
+        data.update({
+            'location': self.location,
+            'grenades': self.grenades,
+            'missiles': self.missiles,
+            'respawn': self.respawn,
+            'model': self.model,
+            'spin': self.spin,
+        })
+        return data
+
+    def setup(self, world):
+        super().setup(world)
+        if world.headless:
+            return
+        # Spun and hidden on its own, so each goody gets a node of its own above the shared geometry.
+        self.display = assets.geometry('goody', self.make_shape)
+        self.display.reparent_to(self.node)
+
+    @classmethod
+    def make_shape(cls):
+        # A cube stood on its corner, until goodies have models of their own.
+        builder = GeomBuilder('goody').add_block(cls.COLOR, (0, 0, 0), (cls.SIZE, cls.SIZE, cls.SIZE),
+                                                 rot=LRotationf(45, 35.26, 0))
+        return NodePath(builder.get_geom_node())
+
+    def attached(self, world):
+        super().attached(world)
+        # Spinning is just for show, so clients do it on their own.
+        rate = max(abs(v) for v in self.spin)
+        if world.camera and self.display and rate:
+            duration = 360.0 / rate
+            self.spinner = LerpHprInterval(self.display, duration, Vec3(self.spin) * duration, startHpr=Vec3(0, 0, 0))
+            self.spinner.loop()
+
+    def removed(self, world):
+        if self.spinner:
+            self.spinner.finish()
+            self.spinner = None
+        super().removed(world)
+
+    def update(self, world, dt):
+        if not self.available:
+            self.countdown -= dt
+            if self.countdown > 0:
+                return False
+            self.available = True
+            return True
+        for player, distance in self.players():
+            player.collect(self.grenades, self.missiles)
+            self.available = False
+            self.countdown = self.respawn
+            return True
+        return False
+
+    def idle(self):
+        # Waiting to respawn takes counting down.
+        return self.available
+
+    def get_state(self):
+        # Scaled to nothing while waiting to respawn.
+        return {
+            'scale': Vec3(1, 1, 1) if self.available else Vec3(0, 0, 0),
+        }
+
+    def set_state(self, state):
+        if not self.display:
+            return
+        if state['scale'].x > 0.5:
+            self.display.show()
+        else:
+            self.display.hide()
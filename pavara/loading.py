@@ -0,0 +1,68 @@
+import logging
+import time
+
+
+logger = logging.getLogger('pavara.loading')
+
+
+def exhaust(steps):
+    """
+    Runs a generator of loading steps to completion in one go, returning its result.
+    """
+    while True:
+        try:
+            next(steps)
+        except StopIteration as stop:
+            return stop.value
+
+
+class SlicedLoader:
+    """
+    Runs a generator of loading steps on the event loop a slice at a time, so a long load doesn't stop the loop from
+    servicing everything else. Each slice runs steps until `budget` seconds have passed, then reports the last step's
+    progress and yields to the loop. Steps yield (stage, done, total) tuples. When the generator finishes, `finished`
+    is called with its return value; if it raises, the error is logged and `failed` is called with it.
+    """
+
+    BUDGET = 0.005
+
+    def __init__(self, loop, steps, progress=None, finished=None, failed=None, budget=BUDGET):
+        self.loop = loop
+        self.steps = steps
+        self.progress = progress
+        self.finished = finished
+        self.failed = failed
+        self.budget = budget
+        self.handle = None
+        self.slices = 0
+
+    def start(self):
+        self.handle = self.loop.call_soon(self.run_slice)
+
+    def cancel(self):
+        if self.handle:
+            self.handle.cancel()
+            self.handle = None
+        self.steps.close()
+
+    def run_slice(self):
+        self.slices += 1
+        deadline = time.perf_counter() + self.budget
+        step = None
+        try:
+            while time.perf_counter() < deadline:
+                step = next(self.steps)
+        except StopIteration as stop:
+            self.handle = None
+            if self.finished:
+                self.finished(stop.value)
+            return
+        except Exception as e:
+            logger.exception('Loading failed')
+            self.handle = None
+            if self.failed:
+                self.failed(e)
+            return
+        if step and self.progress:
+            self.progress(*step)
+        self.handle = self.loop.call_soon(self.run_slice)
@@ -0,0 +1,392 @@
+from panda3d.core import loadPrcFileData
+import msgpack
+import numpy
+
+from .geom import VERTEX_DTYPE, index_type
+from .loading import exhaust
+from .log import configure_logging
+from .maps import Map, parse_map
+from .network import Half, _pack_ext, _unpack_ext
+from .objects import GameObject
+from .world import World
+
+import argparse
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import time
+
+
+logger = logging.getLogger('pavara.mapcache')
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.pavara', 'maps')
+
+
+def read_source(source):
+    """
+    Returns the XML bytes of a map given as a path, a string of XML, or bytes.
+    """
+    if isinstance(source, bytes):
+        return source
+    if source.lstrip().startswith('<'):
+        return source.encode('utf-8')
+    with open(source, 'rb') as f:
+        return f.read()
+
+
+def map_hash(xml):
+    return hashlib.sha1(xml).hexdigest()
+
+
+def is_map_hash(digest):
+    """
+    Whether `digest` looks like something `map_hash` returned. Hashes arrive from peers and become filenames, so
+    anything else (like a path) must never be looked up.
+    """
+    return isinstance(digest, str) and len(digest) == 40 and all(c in '0123456789abcdef' for c in digest)
+
+
+def _pack_full(obj):
+    # Compiled maps keep full precision, even for values sent over the network as Half.
+    return _pack_ext(obj.vec if isinstance(obj, Half) else obj)
+
+
+class CompiledMap:
+    """
+    A map parsed and built ahead of time. It is laid out as:
+
+        preamble: magic, format version, header size
+        header: msgpack of the map attributes, incarnators, and where each blob lives
+        data: the serialized objects (as a stream of msgpack objects), the baked static geometry (in the
+              GeomVertexData layout, ready to copy), the static collision body (as a BAM stream), and the map's XML,
+              each aligned to ALIGN bytes
+
+    so it can be read straight out of a memory-mapped file.
+    """
+
+    MAGIC = b'PAVMAP'
+    VERSION = 4
+    PREAMBLE = struct.Struct('<6sHI')
+    ALIGN = 16
+
+    def __init__(self, buffer):
+        if len(buffer) < self.PREAMBLE.size:
+            raise ValueError('Not a compiled map.')
+        magic, version, size = self.PREAMBLE.unpack_from(buffer)
+        if magic != self.MAGIC:
+            raise ValueError('Not a compiled map.')
+        if version != self.VERSION:
+            raise ValueError('Unsupported compiled map version: {}'.format(version))
+        start = self.PREAMBLE.size
+        self.header = msgpack.unpackb(buffer[start:start + size], use_list=False, raw=False, ext_hook=_unpack_ext)
+        self.buffer = buffer
+        self.data = self.align(start + size)
+
+    @classmethod
+    def align(cls, offset):
+        return -(-offset // cls.ALIGN) * cls.ALIGN
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @classmethod
+    def compile(cls, source):
+        """
+        Loads map XML into a scratch world, and returns the compiled map as bytes.
+        """
+        return exhaust(cls.compile_steps(source))
+
+    @classmethod
+    def compile_steps(cls, source):
+        """
+        Like `compile`, but as a generator that yields ('compiling', done, total) as the map's elements are loaded,
+        then ('baking', ...) and ('packing', ...) as the static geometry and objects are written out.
+        """
+        xml = read_source(source)
+        root = parse_map(xml)
+        world = World()
+        for stage, done, total in Map(**root.attrs).load_steps(root, world, combine_static=True):
+            yield 'compiling', done, total
+
+        blobs = []
+        offset = 0
+
+        def add(blob):
+            nonlocal offset
+            blob = memoryview(blob).cast('B')
+            blobs.append((offset, blob))
+            start = offset
+            offset = cls.align(offset + len(blob))
+            return start, len(blob)
+
+        geometry = []
+        cells = len(world.static_geometry.builders)
+        for done, (name, vertices, indices) in enumerate(world.static_geometry.bake_cells(), 1):
+            indices = indices.astype(index_type(len(vertices))[0])
+            geometry.append((name, len(vertices), add(vertices.view(numpy.uint8))[0], len(indices),
+                             add(indices.view(numpy.uint8))[0]))
+            yield 'baking', done, cells
+        collision = world.static_collision.bake()
+        yield 'baking', cells, cells
+
+        # Objects are packed into their own blob as a stream, so the header stays small and they can be unpacked one
+        # at a time when the map is loaded.
+        packer = msgpack.Packer(use_bin_type=True, default=_pack_full)
+        objects = []
+        for done, obj in enumerate(world.objects.values(), 1):
+            objects.append(packer.pack(obj.serialize()))
+            yield 'packing', done, len(world.objects)
+
+        header = msgpack.packb({
+            'hash': map_hash(xml),
+            'map': root.attrs,
+            'objects': add(b''.join(objects)) + (len(objects),),
+            'incarnators': world.incarnators,
+            'geometry': geometry,
+            'collision': add(collision) if collision else None,
+            'source': add(xml),
+        }, use_bin_type=True, default=_pack_full)
+
+        data = bytearray(cls.align(cls.PREAMBLE.size + len(header)) + offset)
+        cls.PREAMBLE.pack_into(data, 0, cls.MAGIC, cls.VERSION, len(header))
+        data[cls.PREAMBLE.size:cls.PREAMBLE.size + len(header)] = header
+        start = cls.align(cls.PREAMBLE.size + len(header))
+        for blob_offset, blob in blobs:
+            data[start + blob_offset:start + blob_offset + len(blob)] = blob
+        return bytes(data)
+
+    @property
+    def hash(self):
+        return self.header['hash']
+
+    @property
+    def source(self):
+        """
+        The map's XML, as bytes.
+        """
+        return self.blob(*self.header['source'])
+
+    def blob(self, offset, size):
+        return bytes(self.buffer[self.data + offset:self.data + offset + size])
+
+    def array(self, dtype, offset, count):
+        return numpy.frombuffer(self.buffer, dtype=dtype, count=count, offset=self.data + offset)
+
+    def load(self, world):
+        """
+        Attaches the map's objects to the world, using the baked geometry and collision for its static objects.
+        Returns the Map.
+        """
+        return exhaust(self.load_steps(world))
+
+    def load_steps(self, world):
+        """
+        Like `load`, but as a generator that yields ('attaching', done, total) once the static geometry and collision
+        are in place, and after each object is attached.
+        """
+        offset, size, count = self.header['objects']
+        objects = msgpack.Unpacker(use_list=False, raw=False, ext_hook=_unpack_ext, max_buffer_size=max(size, 1))
+        objects.feed(self.blob(offset, size))
+        geometry = []
+        if not world.headless:
+            for name, vertex_count, vertex_offset, index_count, index_offset in self.header['geometry']:
+                vertices = self.array(VERTEX_DTYPE, vertex_offset, vertex_count)
+                indices = self.array(index_type(vertex_count)[0], index_offset, index_count)
+                geometry.append((name, vertices, indices))
+        collision = self.blob(*self.header['collision']) if self.header['collision'] else None
+        world.load_static(geometry, collision)
+        yield 'attaching', 0, count
+        for done, data in enumerate(objects, 1):
+            world.attach(GameObject.deserialize(dict(data)))
+            yield 'attaching', done, count
+        for pos, heading in self.header['incarnators']:
+            world.add_incarnator(pos, heading)
+        world.flush_static()
+        return Map(**self.header['map'])
+
+
+class MapCache:
+    """
+    Compiled maps, kept on disk under `path` by the hash of their XML, and in memory once used. Maps can be looked up
+    by hash alone with `find`, which also knows about XML files registered with `scan`.
+    """
+
+    EXTENSION = '.pvm'
+    CHUNK_SIZE = 16 * 1024
+
+    def __init__(self, path=DEFAULT_CACHE_DIR):
+        self.path = path
+        self.compiled = {}
+        self.sources = {}
+
+    def filename(self, digest):
+        if not is_map_hash(digest):
+            raise ValueError('Not a map hash: {!r}'.format(digest))
+        return os.path.join(self.path, digest + self.EXTENSION)
+
+    def scan(self, directory):
+        """
+        Registers every map XML file in `directory` by hash, so `find` can compile them on demand.
+        """
+        if not os.path.isdir(directory):
+            return
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.xml'):
+                filename = os.path.join(directory, name)
+                self.sources[map_hash(read_source(filename))] = filename
+
+    def find(self, digest):
+        """
+        Returns the CompiledMap with the given hash, or None if neither it nor its XML is available locally.
+        """
+        return exhaust(self.find_steps(digest))
+
+    def find_steps(self, digest):
+        """
+        Like `find`, but as a generator that yields progress if the map has to be compiled.
+        """
+        if not is_map_hash(digest):
+            return None
+        if digest in self.compiled:
+            return self.compiled[digest]
+        try:
+            compiled = CompiledMap.open(self.filename(digest))
+        except (OSError, ValueError):
+            compiled = None
+        if compiled and compiled.hash == digest:
+            self.compiled[digest] = compiled
+            return compiled
+        if digest in self.sources:
+            return (yield from self.get_steps(self.sources[digest]))
+        return None
+
+    def chunk(self, digest, index):
+        """
+        Returns (count, data) for chunk `index` of a map's XML, or None if the map or chunk isn't available.
+        """
+        if not isinstance(index, int):
+            return None
+        compiled = self.find(digest)
+        if compiled is None:
+            return None
+        source = compiled.source
+        count = max(1, -(-len(source) // self.CHUNK_SIZE))
+        if not 0 <= index < count:
+            return None
+        return count, source[index * self.CHUNK_SIZE:(index + 1) * self.CHUNK_SIZE]
+
+    def get(self, source):
+        """
+        Returns the CompiledMap for map XML (see `read_source`), compiling and storing it if it isn't cached yet.
+        """
+        return exhaust(self.get_steps(source))
+
+    def get_steps(self, source):
+        """
+        Like `get`, but as a generator that yields progress if the map has to be compiled.
+        """
+        xml = read_source(source)
+        digest = map_hash(xml)
+        if digest in self.compiled:
+            return self.compiled[digest]
+        filename = self.filename(digest)
+        try:
+            compiled = CompiledMap.open(filename)
+            if compiled.hash != digest:
+                raise ValueError('Hash mismatch.')
+        except (OSError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.warning('Recompiling %s: %s', filename, e)
+            compiled = CompiledMap(self.store(filename, (yield from CompiledMap.compile_steps(xml))))
+        self.compiled[digest] = compiled
+        return compiled
+
+    def store(self, filename, data):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            # Write to a temporary file first, so other processes never see a partial map.
+            temp = '{}.{}.tmp'.format(filename, os.getpid())
+            with open(temp, 'wb') as f:
+                f.write(data)
+            os.replace(temp, filename)
+        except OSError as e:
+            logger.warning('Could not store compiled map %s: %s', filename, e)
+        return data
+
+    def load(self, source, world):
+        """
+        Loads map XML into the world from the cache, returning the Map.
+        """
+        return self.get(source).load(world)
+
+
+class MapDownload:
+    """
+    Fetches a map's XML from a peer one chunk at a time, by sending 'map_request' messages with `send` and feeding
+    each 'map_chunk' reply to `received`. The finished map is checked against its hash before it is handed back, ready
+    to be compiled into the cache with `MapCache.get` or `MapCache.get_steps`. Peers can't be trusted to send what they
+    say they will, so anything bigger than `MAX_SIZE`, or chunks that disagree about how many there are, abort the
+    download.
+    """
+
+    MAX_SIZE = 4 * 1024 * 1024  # bytes; maps that ship with the game are around 10KB.
+
+    def __init__(self, digest, send):
+        self.digest = digest
+        self.send = send
+        self.chunks = []
+        self.count = None
+
+    def start(self):
+        self.send('map_request', map=self.digest, index=0)
+
+    def received(self, index, count, data):
+        """
+        Returns the map's XML once the last chunk has arrived, or None while more are needed. Raises ValueError if the
+        download should be abandoned.
+        """
+        if index != len(self.chunks):
+            return None
+        if self.count is None:
+            # Chunks are at most CHUNK_SIZE each, so capping their number caps the map's size.
+            if not isinstance(count, int) or not 0 < count <= self.MAX_SIZE // MapCache.CHUNK_SIZE:
+                raise ValueError('Map {} has a bad chunk count {!r}'.format(self.digest, count))
+            self.count = count
+        elif count != self.count:
+            raise ValueError('Map {} changed from {} chunks to {!r}'.format(self.digest, self.count, count))
+        if not isinstance(data, bytes) or len(data) > MapCache.CHUNK_SIZE:
+            raise ValueError('Map {} has a bad chunk {}'.format(self.digest, index))
+        self.chunks.append(data)
+        if len(self.chunks) < count:
+            self.send('map_request', map=self.digest, index=len(self.chunks))
+            return None
+        xml = b''.join(self.chunks)
+        if map_hash(xml) != self.digest:
+            raise ValueError('Downloaded map does not match hash {}'.format(self.digest))
+        return xml
+
+
+if __name__ == '__main__':
+    configure_logging()
+    loadPrcFileData('', 'window-type none')
+
+    parser = argparse.ArgumentParser(description='Precompile Pavara maps')
+    parser.add_argument('-c', '--cache', default=DEFAULT_CACHE_DIR)
+    parser.add_argument('paths', nargs='*', default=['maps'])
+    args = parser.parse_args()
+
+    cache = MapCache(args.cache)
+    for path in args.paths:
+        if os.path.isdir(path):
+            filenames = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.xml'))
+        else:
+            filenames = [path]
+        for filename in filenames:
+            start = time.perf_counter()
+            compiled = cache.get(filename)
+            logger.info('%s -> %s (%d bytes, %.1fms)', filename, cache.filename(compiled.hash), len(compiled.buffer),
+                        (time.perf_counter() - start) * 1000.0)
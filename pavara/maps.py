@@ -2,8 +2,10 @@ from panda3d.core import LColor, Vec3
 import drill
 
 from .constants import DEFAULT_GROUND_COLOR, DEFAULT_HORIZON_COLOR, DEFAULT_SKY_COLOR
-from .objects import Block, Ground, Ramp
-from .sky import Sky
+from .loading import exhaust
+from .items import Goody, Teleporter
+from .objects import Block, Dome, Ground, Ramp, Wedge
+from .sky import Celestial, Sky, Starfield
 
 
 class Map:
@@ -46,7 +48,53 @@ class Map:
             return float(default) if isinstance(default, str) else default
         return float(s)
 
-    def load(self, root, world, **context):
+    def parse_int(self, s, default=0):
+        return int(self.parse_float(s, default))
+
+    def parse_bool(self, s, default=False):
+        if s is None or not s.strip():
+            return default
+        return s.strip().lower() in ('true', 'yes', '1')
+
+    def parse_hpr(self, s):
+        """
+        Parses a "yaw,pitch,roll" triple, which (unlike positions) is the same in every coordinate system.
+        """
+        if s is None or not s.strip():
+            return Vec3(0, 0, 0)
+        parts = tuple(float(v.strip()) for v in s.split(','))
+        if len(parts) != 3:
+            raise ValueError('Expected 3 dimensions in "{}"'.format(s))
+        return Vec3(*parts)
+
+    def parse_ypr(self, xml):
+        return Vec3(
+            self.parse_float(xml.attrs.get('yaw')),
+            self.parse_float(xml.attrs.get('pitch')),
+            self.parse_float(xml.attrs.get('roll'))
+        )
+
+    def load(self, root, world, combine_static=False, **context):
+        """
+        Attaches the map's objects to the world. With `combine_static`, the collision shapes of immovable objects are
+        merged into a single compound body when the world's static objects are flushed.
+        """
+        exhaust(self.load_steps(root, world, combine_static=combine_static, **context))
+
+    def count(self, root):
+        """
+        The number of elements `load_steps` will step through.
+        """
+        return sum(self.count(xml) if xml.tagname == 'set' else 1 for xml in root)
+
+    def load_steps(self, root, world, combine_static=False, total=None, **context):
+        """
+        Like `load`, but as a generator that yields ('parsing', done, total) after each element.
+        """
+        if combine_static:
+            world.combine_static()
+        if total is None:
+            total = [0, self.count(root)]
         sky = None
         for xml in root:
             if xml.tagname == 'block':
@@ -56,18 +104,48 @@ class Map:
                     self.parse_color(xml['color']),
                     self.parse_float(xml.attrs.get('mass'), default=context.get('mass', 0)),
                 ))
-            elif xml.tagname == 'ramp':
+            elif xml.tagname in ('ramp', 'blockramp'):
                 world.attach(Ramp(
                     self.parse_vector(xml['base']),
                     self.parse_vector(xml['top']),
                     self.parse_float(xml.attrs.get('width'), 8),
                     self.parse_float(xml.attrs.get('thickness')),
                     self.parse_color(xml.attrs.get('color')),
-                    Vec3(
-                        self.parse_float(xml.attrs.get('yaw')),
-                        self.parse_float(xml.attrs.get('pitch')),
-                        self.parse_float(xml.attrs.get('roll'))
-                    )
+                    self.parse_ypr(xml),
+                ))
+            elif xml.tagname == 'wedge':
+                world.attach(Wedge(
+                    self.parse_vector(xml['base']),
+                    self.parse_vector(xml['top']),
+                    self.parse_float(xml.attrs.get('width'), 8),
+                    self.parse_color(xml.attrs.get('color')),
+                    self.parse_ypr(xml),
+                    self.parse_float(xml.attrs.get('mass'), default=context.get('mass', 0)),
+                ))
+            elif xml.tagname == 'dome':
+                world.attach(Dome(
+                    self.parse_vector(xml['center']),
+                    self.parse_float(xml.attrs.get('radius'), 1),
+                    self.parse_color(xml.attrs.get('color')),
+                    self.parse_float(xml.attrs.get('mass'), default=context.get('mass', 0)),
+                ))
+            elif xml.tagname == 'teleporter':
+                world.attach(Teleporter(
+                    self.parse_vector(xml['location']),
+                    xml.attrs.get('group'),
+                    xml.attrs.get('destination'),
+                    self.parse_float(xml.attrs.get('activeRadius'), Teleporter.ACTIVE_RADIUS),
+                    self.parse_float(xml.attrs.get('deadRadius')),
+                    self.parse_bool(xml.attrs.get('disorient'), True),
+                ))
+            elif xml.tagname == 'goody':
+                world.attach(Goody(
+                    self.parse_vector(xml['location']),
+                    self.parse_int(xml.attrs.get('grenades')),
+                    self.parse_int(xml.attrs.get('missiles')),
+                    self.parse_float(xml.attrs.get('respawn')),
+                    xml.attrs.get('model'),
+                    self.parse_hpr(xml.attrs.get('spin')),
                 ))
             elif xml.tagname == 'ground':
                 if sky:
@@ -78,21 +156,51 @@ class Map:
                     self.parse_color(xml.attrs.get('color'), DEFAULT_SKY_COLOR),
                     self.parse_color(xml.attrs.get('horizon'), DEFAULT_HORIZON_COLOR),
                 ))
+                for child in xml:
+                    if child.tagname == 'celestial':
+                        world.attach(Celestial(
+                            self.parse_float(child.attrs.get('azimuth')),
+                            self.parse_float(child.attrs.get('elevation')),
+                            self.parse_color(child.attrs.get('color')),
+                            self.parse_float(child.attrs.get('intensity'), 1.0),
+                            self.parse_float(child.attrs.get('size'), 30.0),
+                            self.parse_bool(child.attrs.get('visible')),
+                        ))
+                    elif child.tagname == 'starfield':
+                        world.attach(Starfield(
+                            self.parse_int(child.attrs.get('seed')),
+                            self.parse_int(child.attrs.get('count'), 100),
+                            self.parse_float(child.attrs.get('minSize'), 1.0),
+                            self.parse_float(child.attrs.get('maxSize'), 1.0),
+                            child.attrs.get('mode'),
+                        ))
             elif xml.tagname == 'incarnator':
                 world.add_incarnator(
                     self.parse_vector(xml['location']),
                     self.parse_float(xml['heading']),
                 )
-            elif xml.tagname == 'set':
+            if xml.tagname == 'set':
                 context.update(xml.attrs)
-                self.load(xml, world, **context)
+                yield from self.load_steps(xml, world, total=total, **context)
+            else:
+                total[0] += 1
+                yield 'parsing', total[0], total[1]
 
 
-def load_map(filename, world=None):
-    root = drill.parse(filename)
+def parse_map(source):
+    """
+    Parses map XML from a path, a string, or bytes, returning the root element.
+    """
+    root = drill.parse(source)
     if root.tagname.lower() != 'map':
         raise Exception('Expected "map" root element.')
+    return root
+
+
+def load_map(filename, world=None, combine_static=False):
+    root = parse_map(filename)
     m = Map(**root.attrs)
     if world:
-        m.load(root, world)
+        m.load(root, world, combine_static=combine_static)
+        world.flush_static()
     return m
@@ -0,0 +1,102 @@
+import bisect
+import time
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram of durations, in milliseconds.
+    """
+
+    BUCKETS = (0.5, 1, 2, 5, 10, 20, 33, 50, 100)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(self.BUCKETS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound of the bucket containing the given fraction of samples (None for the overflow bucket).
+        """
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.BUCKETS + (None,), self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return None
+
+    def __str__(self):
+        p95 = self.percentile(0.95)
+        p95 = '<={}ms'.format(p95) if p95 is not None else '>{}ms'.format(self.BUCKETS[-1])
+        return 'mean={:.2f}ms p95{} max={:.2f}ms'.format(self.mean, p95, self.max)
+
+
+class TickMetrics:
+    """
+    Accumulates time spent in each phase of a tick, and rolls the totals into per-phase histograms at the end of the
+    tick. Phases can be timed more than once per tick (e.g. serializing several messages).
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.current = {}
+        self.ticks = 0
+        self.steps = 0
+        self.dropped = 0
+
+    def add(self, phase, seconds):
+        self.current[phase] = self.current.get(phase, 0.0) + seconds
+
+    def timer(self, phase):
+        return PhaseTimer(self, phase)
+
+    def commit(self):
+        self.ticks += 1
+        for phase, seconds in self.current.items():
+            if phase not in self.histograms:
+                self.histograms[phase] = Histogram()
+            self.histograms[phase].add(seconds * 1000.0)
+        self.current = {}
+
+    def reset(self):
+        self.histograms = {}
+        self.ticks = 0
+        self.steps = 0
+        self.dropped = 0
+
+    def report(self):
+        lines = ['{} ticks, {} steps, {} dropped'.format(self.ticks, self.steps, self.dropped)]
+        for phase in sorted(self.histograms):
+            lines.append('  {}: {}'.format(phase, self.histograms[phase]))
+        return '\n'.join(lines)
+
+
+class PhaseTimer:
+
+    __slots__ = ('metrics', 'phase', 'start')
+
+    def __init__(self, metrics, phase):
+        self.metrics = metrics
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add(self.phase, time.perf_counter() - self.start)
@@ -1,33 +1,98 @@
-from panda3d.core import LVecBase3f, LVecBase4f
+from panda3d.core import LQuaternionf, LVecBase3f, LVecBase4f
 import msgpack
 
 import asyncio
+import random
 import socket
+import struct
+import time
 import uuid
 
 
-def _pack_vec(obj):
-    if isinstance(obj, LVecBase3f):
-        return {'__type__': 'LVecBase3f', 'xyz': (obj.x, obj.y, obj.z)}
+class Half:
+    """
+    Wraps a vector so it is packed as float16 components, for values like colors where size matters more than
+    precision. It is unpacked as a regular vector.
+    """
+
+    __slots__ = ('vec',)
+
+    def __init__(self, vec):
+        self.vec = vec
+
+
+EXT_VEC3 = 1
+EXT_VEC4 = 2
+EXT_QUAT = 3
+EXT_HALF_VEC3 = 4
+EXT_HALF_VEC4 = 5
+
+_VEC3 = struct.Struct('<3f')
+_VEC4 = struct.Struct('<4f')
+_HALF_VEC3 = struct.Struct('<3e')
+_HALF_VEC4 = struct.Struct('<4e')
+
+_EXT_TYPES = {
+    EXT_VEC3: (LVecBase3f, _VEC3),
+    EXT_VEC4: (LVecBase4f, _VEC4),
+    EXT_QUAT: (LQuaternionf, _VEC4),
+    EXT_HALF_VEC3: (LVecBase3f, _HALF_VEC3),
+    EXT_HALF_VEC4: (LVecBase4f, _HALF_VEC4),
+}
+
+
+def _pack_ext(obj):
+    if isinstance(obj, Half):
+        if isinstance(obj.vec, LVecBase3f):
+            return msgpack.ExtType(EXT_HALF_VEC3, _HALF_VEC3.pack(*obj.vec))
+        return msgpack.ExtType(EXT_HALF_VEC4, _HALF_VEC4.pack(*obj.vec))
+    # LQuaternionf is a subclass of LVecBase4f, so it needs to be checked first.
+    if isinstance(obj, LQuaternionf):
+        return msgpack.ExtType(EXT_QUAT, _VEC4.pack(*obj))
+    elif isinstance(obj, LVecBase3f):
+        return msgpack.ExtType(EXT_VEC3, _VEC3.pack(*obj))
     elif isinstance(obj, LVecBase4f):
-        return {'__type__': 'LVecBase4f', 'xyzw': (obj.x, obj.y, obj.z, obj.w)}
+        return msgpack.ExtType(EXT_VEC4, _VEC4.pack(*obj))
     return obj
 
 
-def _unpack_vec(obj):
-    if obj.get('__type__') == 'LVecBase3f':
-        return LVecBase3f(*obj['xyz'])
-    elif obj.get('__type__') == 'LVecBase4f':
-        return LVecBase4f(*obj['xyzw'])
-    return obj
+def _unpack_ext(code, data):
+    if code not in _EXT_TYPES:
+        return msgpack.ExtType(code, data)
+    cls, fmt = _EXT_TYPES[code]
+    return cls(*fmt.unpack(data))
+
+
+def pack(cmd, **args):
+    return msgpack.packb((cmd, args), use_bin_type=True, default=_pack_ext)
+
+
+class TrafficCounter:
+    """
+    Counts message encodes and bytes written. Call `tick` at the end of each reporting interval to roll the counts
+    over.
+    """
+
+    def __init__(self):
+        self.encodes = 0
+        self.bytes = 0
+        self.last_encodes = 0
+        self.last_bytes = 0
+
+    def tick(self):
+        self.last_encodes = self.encodes
+        self.last_bytes = self.bytes
+        self.encodes = 0
+        self.bytes = 0
 
 
 class MsgpackProtocol (asyncio.Protocol):
 
-    def __init__(self, delegate, pid=None):
+    def __init__(self, delegate, pid=None, counter=None):
         self.pid = pid or str(uuid.uuid4())
         self.delegate = delegate
-        self.unpacker = msgpack.Unpacker(use_list=False, raw=False, object_hook=_unpack_vec)
+        self.counter = counter
+        self.unpacker = msgpack.Unpacker(use_list=False, raw=False, ext_hook=_unpack_ext)
         self.transport = None
         self.address = ''
         self.port = 0
@@ -47,5 +112,124 @@ class MsgpackProtocol (asyncio.Protocol):
         self.delegate.disconnected(self)
 
     def send(self, cmd, **args):
-        data = msgpack.packb((cmd, args), use_bin_type=True, default=_pack_vec)
+        data = pack(cmd, **args)
+        if self.counter:
+            self.counter.encodes += 1
+        self.write(data)
+
+    def write(self, data):
+        """
+        Writes an already packed message, so the same buffer can be sent to many connections.
+        """
+        if self.counter:
+            self.counter.bytes += len(data)
         self.transport.write(data)
+
+
+class DatagramProtocol (asyncio.DatagramProtocol):
+    """
+    Unreliable channel for messages where only the latest one matters, like state. Each message is tagged with a
+    sequence number and split into MTU-sized fragments, and receivers drop anything older than the last message they
+    delivered from the same address. Anything that can't be a message (too many fragments, fragments that disagree,
+    payloads that don't decode) is dropped too, and addresses that go quiet are forgotten, since anyone can send
+    datagrams from any address. `loss` drops that fraction of incoming datagrams, to simulate a lossy link.
+    """
+
+    HEADER = struct.Struct('!IHH')  # sequence, fragment index, fragment count
+    MTU = 1200
+    MAX_FRAGMENTS = 64  # Larger messages can't be reassembled, so the most a sender can make us buffer is about 75KB.
+    EXPIRY = 30.0  # seconds an address can go without sending anything before it is forgotten
+
+    def __init__(self, delegate, loss=0.0, counter=None):
+        self.delegate = delegate
+        self.loss = loss
+        self.counter = counter
+        self.transport = None
+        self.sequence = 0
+        self.delivered = {}
+        self.fragments = {}
+        # When each address was last heard from, and when to next forget the ones that have gone quiet.
+        self.heard = {}
+        self.next_expiry = time.monotonic() + self.EXPIRY
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.loss and random.random() < self.loss:
+            return
+        if len(data) < self.HEADER.size:
+            return
+        sequence, index, count = self.HEADER.unpack_from(data)
+        if sequence <= self.delivered.get(addr, 0) or index >= count or count > self.MAX_FRAGMENTS:
+            return
+        self.expire()
+        self.heard[addr] = time.monotonic()
+        payload = data[self.HEADER.size:]
+        if count > 1:
+            pending_sequence, parts = self.fragments.get(addr, (0, None))
+            if sequence < pending_sequence:
+                return
+            if sequence > pending_sequence:
+                # A newer message supersedes whatever was being reassembled.
+                parts = [None] * count
+                self.fragments[addr] = (sequence, parts)
+            elif len(parts) != count:
+                return
+            parts[index] = payload
+            if None in parts:
+                return
+            del self.fragments[addr]
+            payload = b''.join(parts)
+        self.delivered[addr] = sequence
+        try:
+            cmd, args = msgpack.unpackb(payload, use_list=False, raw=False, ext_hook=_unpack_ext)
+        except Exception:
+            return
+        if not isinstance(cmd, str) or not isinstance(args, dict) or not all(isinstance(key, str) for key in args):
+            return
+        self.delegate.datagram_received(self, addr, cmd, **args)
+
+    def expire(self):
+        """
+        Forgets addresses that haven't sent anything for `EXPIRY` seconds, checking at most that often.
+        """
+        now = time.monotonic()
+        if now < self.next_expiry:
+            return
+        self.next_expiry = now + self.EXPIRY
+        for addr in [addr for addr, heard in self.heard.items() if heard < now - self.EXPIRY]:
+            self.forget(addr)
+
+    def forget(self, addr):
+        """
+        Drops everything kept about an address, e.g. once its player has disconnected.
+        """
+        self.heard.pop(addr, None)
+        self.delivered.pop(addr, None)
+        self.fragments.pop(addr, None)
+
+    def error_received(self, exc):
+        pass
+
+    def fragment(self, data):
+        """
+        Splits a packed message into datagrams under a new sequence number. The result can be written to any number
+        of addresses.
+        """
+        self.sequence += 1
+        size = self.MTU - self.HEADER.size
+        count = max((len(data) + size - 1) // size, 1)
+        return [self.HEADER.pack(self.sequence, index, count) + data[index * size:(index + 1) * size]
+                for index in range(count)]
+
+    def send(self, cmd, **args):
+        if self.counter:
+            self.counter.encodes += 1
+        self.write(self.fragment(pack(cmd, **args)))
+
+    def write(self, datagrams, addr=None):
+        for datagram in datagrams:
+            if self.counter:
+                self.counter.bytes += len(datagram)
+            self.transport.sendto(datagram, addr)
@@ -1,15 +1,20 @@
-from direct.interval.LerpInterval import LerpPosHprInterval
 from panda3d.bullet import BulletBoxShape, BulletConvexHullShape, BulletGhostNode, BulletPlaneShape, BulletRigidBodyNode
-from panda3d.core import NodePath, Point3, Vec3
+from panda3d.core import LRotationf, NodePath, Point3, TransformState, Vec3
 
+from .assets import assets
 from .constants import Collision
-from .geom import GeomBuilder
+from .geom import GeomBuilder, ramp_corners, to_cartesian, wedge_corners
+from .network import Half
 
 import importlib
+import math
 
 
 class GameObject:
     world_id = None
+    always_relevant = False  # Whether clients should get this object's state regardless of distance.
+    poolable = False  # Whether the world can park this object when it is removed, for `World.spawn` to reuse.
+    parked = False
 
     def __init__(self, name=None):
         self.name = name or '{}-{}'.format(self.__class__.__name__, id(self))
@@ -23,13 +28,43 @@ class GameObject:
     def update(self, world, dt):
         return False
 
+    def idle(self):
+        """
+        Whether the object can go without `update` calls until it is woken up with `World.wake`. Objects that don't do
+        anything in `update` never need it called.
+        """
+        return type(self).update is GameObject.update
+
+    def listens(self):
+        """
+        Whether the object wants `collision` calls. Objects that don't do anything in `collision` don't get them.
+        """
+        return type(self).collision is not GameObject.collision
+
     def attached(self, world):
         pass
 
     def removed(self, world):
         pass
 
+    def park(self, world):
+        """
+        Called instead of `removed` when the world keeps this object around to reuse. It should go quiet without
+        giving up anything that is costly to set up again.
+        """
+        self.parked = True
+
+    def unpark(self, world):
+        """
+        Called instead of `setup` and `attached` when a parked object is attached again.
+        """
+        self.parked = False
+
     def collision(self, world, obj):
+        """
+        Called by `World.dispatch_collisions` when this object's body starts touching `obj`'s (None for bodies that
+        aren't objects, like the combined static body).
+        """
         pass
 
     def serialize(self):
@@ -51,27 +86,53 @@ class GameObject:
     def get_state(self):
         pass
 
-    def set_state(self, state, fluid=True):
+    def set_state(self, state):
         pass
 
 
 class PhysicalObject (GameObject):
     body_class = BulletGhostNode
+    combined = False  # Set when the body's shape has been merged into the world's combined static body.
+    PARKING = Point3(0, 0, -10000)  # Where parked bodies wait, well away from anything they could touch.
+    wakes_overlaps = False  # Set to wake idle ghosts (like triggers) this object's body moves into.
 
     def __init__(self, name=None):
         super().__init__(name=name)
         self.body = self.body_class('{}-Body'.format(self.name))
+        # So objects can be found from the bodies Bullet reports, e.g. in a ghost's overlapping nodes.
+        self.body.set_python_tag('object', self)
         self.body.set_into_collide_mask(Collision.GHOST)
         self.node = NodePath(self.body)
 
     def attached(self, world):
-        world.physics.attach(self.body)
+        if not self.combined:
+            world.physics.attach(self.body)
         self.node.reparent_to(world.node)
 
     def removed(self, world):
-        world.physics.remove(self.body)
+        if not self.combined:
+            world.physics.remove(self.body)
         self.node.remove_node()
 
+    def park(self, world):
+        # Parked bodies stay in the physics world, so reusing them doesn't cost a Bullet remove and add, but they stop
+        # colliding with anything and drop out of the scene.
+        super().park(world)
+        self.into_mask = self.body.get_into_collide_mask()
+        self.body.set_into_collide_mask(Collision.NONE)
+        self.node.set_pos_hpr(self.PARKING, Vec3(0, 0, 0))
+        self.node.stash()
+        # Bullet only reports contacts it hasn't seen before, and would otherwise keep these until the next step, so an
+        # object spawned again right where it was parked wouldn't hear about touching what it touched before.
+        for manifold in world.physics.get_manifolds():
+            if self.body in (manifold.get_node0(), manifold.get_node1()):
+                manifold.clear_manifold()
+
+    def unpark(self, world):
+        super().unpark(world)
+        self.body.set_into_collide_mask(self.into_mask)
+        self.node.unstash()
+
     def hit(self, pos, distance):
         pass
 
@@ -81,12 +142,9 @@ class PhysicalObject (GameObject):
             'hpr': self.node.get_hpr(),
         }
 
-    def set_state(self, state, fluid=True):
-        if fluid:
-            LerpPosHprInterval(self.node, 1.0 / 30.0, state['pos'], state['hpr']).start()
-        else:
-            self.node.set_pos(state['pos'])
-            self.node.set_hpr(state['hpr'])
+    def set_state(self, state):
+        self.node.set_pos(state['pos'])
+        self.node.set_hpr(state['hpr'])
 
 
 class SolidObject (PhysicalObject):
@@ -96,9 +154,14 @@ class SolidObject (PhysicalObject):
         super().__init__(name=name)
         self.mass = float(mass)
         self.velocity = Vec3()
+        self.was_active = False
         self.body.set_mass(self.mass)
         self.body.set_into_collide_mask(Collision.SOLID)
 
+    @property
+    def static(self):
+        return self.mass == 0
+
     def serialize(self):
         data = super().serialize()
         data.update({
@@ -106,6 +169,19 @@ class SolidObject (PhysicalObject):
         })
         return data
 
+    def park(self, world):
+        super().park(world)
+        self.body.set_linear_velocity(Vec3(0, 0, 0))
+        self.body.set_angular_velocity(Vec3(0, 0, 0))
+        self.body.clear_forces()
+        self.body.set_active(False)
+        self.velocity = Vec3()
+        self.was_active = False
+
+    def unpark(self, world):
+        super().unpark(world)
+        self.body.set_active(True)
+
     def hit(self, pos, distance):
         power = (1.0 / (distance * distance)) * 20000.0
         impulse = (self.node.get_pos() - pos) * power
@@ -113,7 +189,15 @@ class SolidObject (PhysicalObject):
         self.body.apply_central_impulse(impulse)
 
     def update(self, world, dt):
-        return self.body.is_active()
+        # Bodies can still move on the step they fall asleep, so report one more update after deactivation.
+        active = self.body.is_active()
+        dirty = active or self.was_active
+        self.was_active = active
+        return dirty
+
+    def idle(self):
+        # Static bodies never move, and ones that have gone to sleep won't until something wakes them.
+        return self.static or not (self.was_active or self.body.is_active())
 
 
 class Block (SolidObject):
@@ -129,17 +213,26 @@ class Block (SolidObject):
         data.update({
             'center': self.center,
             'size': self.size,
-            'color': self.color,
+            'color': Half(self.color),
         })
         return data
 
+    def make_shape(self):
+        return BulletBoxShape(Vec3(self.size.x / 2.0, self.size.y / 2.0, self.size.z / 2.0))
+
     def setup(self, world):
-        self.body.add_shape(BulletBoxShape(Vec3(self.size.x / 2.0, self.size.y / 2.0, self.size.z / 2.0)))
+        self.combined = world.combine(self, self.make_shape, TransformState.make_pos(self.center))
+        if not self.combined:
+            self.body.add_shape(self.make_shape())
         self.body.set_angular_damping(1.0)
         self.body.set_restitution(0.0)
-        self.node.attach_new_node(GeomBuilder().add_block(self.color, (0, 0, 0), self.size).get_geom_node())
+        if not world.batch(self, self.center):
+            self.node.attach_new_node(GeomBuilder().add_block(self.color, (0, 0, 0), self.size).get_geom_node())
         self.node.set_pos(self.center)
 
+    def build_geometry(self, builder):
+        builder.add_block(self.color, self.center, self.size)
+
 
 class Ramp (SolidObject):
 
@@ -160,27 +253,125 @@ class Ramp (SolidObject):
             'top': self.top,
             'width': self.width,
             'thickness': self.thickness,
-            'color': self.color,
+            'color': Half(self.color),
             'ypr': self.ypr,
         })
         return data
 
+    def make_shape(self):
+        shape = BulletConvexHullShape()
+        for corner in ramp_corners(self.base, self.top, self.width, self.thickness)[0]:
+            shape.add_point(Point3(*corner))
+        return shape
+
     def setup(self, world):
-        rel_base = Point3(self.base - (self.midpoint - Point3(0, 0, 0)))
-        rel_top = Point3(self.top - (self.midpoint - Point3(0, 0, 0)))
-        self.geom = GeomBuilder().add_ramp(self.color, rel_base, rel_top, self.width, self.thickness).get_geom_node()
-        self.node.attach_new_node(self.geom)
+        if not world.batch(self, self.midpoint):
+            rel_base = Point3(self.base - (self.midpoint - Point3(0, 0, 0)))
+            rel_top = Point3(self.top - (self.midpoint - Point3(0, 0, 0)))
+            builder = GeomBuilder().add_ramp(self.color, rel_base, rel_top, self.width, self.thickness)
+            self.node.attach_new_node(builder.get_geom_node())
+
+        self.combined = world.combine(self, self.make_shape, TransformState.make_pos_hpr(self.midpoint, self.ypr))
+        if not self.combined:
+            self.body.add_shape(self.make_shape())
+
+        self.node.set_pos(self.midpoint)
+        self.node.set_hpr(self.ypr)
+
+    def build_geometry(self, builder):
+        builder.add_ramp(self.color, self.base, self.top, self.width, self.thickness, rot=LRotationf(*self.ypr))
+
 
+class Wedge (SolidObject):
+
+    def __init__(self, base, top, width, color, ypr, mass=0, name=None):
+        super().__init__(mass, name=name)
+        self.base = base
+        self.top = top
+        self.width = width
+        self.color = color
+        self.ypr = ypr
+        self.midpoint = Point3((self.base + self.top) / 2.0)
+
+    def serialize(self):
+        data = super().serialize()
+        data.update({
+            'base': self.base,
+            'top': self.top,
+            'width': self.width,
+            'color': Half(self.color),
+            'ypr': self.ypr,
+        })
+        return data
+
+    def make_shape(self):
         shape = BulletConvexHullShape()
-        shape.add_geom(self.geom.get_geom(0))
-        self.body.add_shape(shape)
+        for corner in wedge_corners(self.base, self.top, self.width)[0]:
+            shape.add_point(Point3(*corner))
+        return shape
 
+    def setup(self, world):
+        self.combined = world.combine(self, self.make_shape, TransformState.make_pos_hpr(self.midpoint, self.ypr))
+        if not self.combined:
+            self.body.add_shape(self.make_shape())
+        self.body.set_restitution(0.0)
+        if not world.batch(self, self.midpoint):
+            rel_base = Point3(self.base - (self.midpoint - Point3(0, 0, 0)))
+            rel_top = Point3(self.top - (self.midpoint - Point3(0, 0, 0)))
+            builder = GeomBuilder().add_wedge(self.color, rel_base, rel_top, self.width)
+            self.node.attach_new_node(builder.get_geom_node())
         self.node.set_pos(self.midpoint)
         self.node.set_hpr(self.ypr)
 
+    def build_geometry(self, builder):
+        builder.add_wedge(self.color, self.base, self.top, self.width, rot=LRotationf(*self.ypr))
+
+
+class Dome (SolidObject):
+    SAMPLES = 32  # around the rim
+    PLANES = 8  # from the rim to the top
+
+    def __init__(self, center, radius, color, mass=0, name=None):
+        super().__init__(mass, name=name)
+        self.center = center
+        self.radius = radius
+        self.color = color
+
+    def serialize(self):
+        data = super().serialize()
+        data.update({
+            'center': self.center,
+            'radius': self.radius,
+            'color': Half(self.color),
+        })
+        return data
+
+    def make_shape(self):
+        shape = BulletConvexHullShape()
+        azimuths = [math.pi * 2 * i / self.SAMPLES for i in range(self.SAMPLES)]
+        elevations = [math.pi / 2 * i / (self.PLANES - 1) for i in range(self.PLANES - 1)]
+        for elevation in elevations:
+            for azimuth in azimuths:
+                shape.add_point(Point3(*to_cartesian(azimuth, elevation, self.radius)))
+        shape.add_point(Point3(0, 0, self.radius))
+        return shape
+
+    def setup(self, world):
+        self.combined = world.combine(self, self.make_shape, TransformState.make_pos(self.center))
+        if not self.combined:
+            self.body.add_shape(self.make_shape())
+        self.body.set_restitution(0.0)
+        if not world.batch(self, self.center):
+            builder = GeomBuilder().add_dome(self.color, (0, 0, 0), self.radius, self.SAMPLES, self.PLANES)
+            self.node.attach_new_node(builder.get_geom_node())
+        self.node.set_pos(self.center)
+
+    def build_geometry(self, builder):
+        builder.add_dome(self.color, self.center, self.radius, self.SAMPLES, self.PLANES)
+
 
 class Ground (SolidObject):
 
     def setup(self, world):
-        self.body.add_shape(BulletPlaneShape(Vec3(0, 0, 1), 0))
+        self.body.add_shape(assets.shape(('plane', 0, 0, 1, 0), lambda: BulletPlaneShape(Vec3(0, 0, 1), 0)))
         self.body.set_restitution(0.0)
@@ -1,15 +1,16 @@
-from direct.interval.IntervalGlobal import Parallel
-from direct.interval.LerpInterval import LerpHprInterval, LerpPosHprInterval
 from panda3d.bullet import BulletBoxShape, BulletConvexHullShape
 from panda3d.core import TransformState, Vec3
 
+from .assets import assets
 from .constants import Collision
 from .objects import PhysicalObject
 
+import collections
 import math
 
 
 class Player (PhysicalObject):
+    wakes_overlaps = True
     TURN_ACCEL = 0.1  # seconds to reach TURN_SPEED
     TURN_SPEED = 75.0  # deg/sec
     TURN_DAMPER = 0.5  # The fraction of motor power to reduce turn power by while moving
@@ -18,6 +19,10 @@ class Player (PhysicalObject):
     MAX_SWIVEL = 60.0  # Maximum head swivel (side-to-side) in degrees
     MAX_PITCH = 20.0  # Maximum head pitch (up-and-down) in degrees
     CAMERA_OFFSET = Vec3(0, 0.5, 0.5)  # Where the camera should be placed relative to the head
+    INPUT_BITS = {'forward': 1, 'backward': 2, 'left': 4, 'right': 8, 'center': 16}
+    MAX_INPUT_BACKLOG = 3  # Queued input frames beyond this are folded together instead of lagging further behind
+    MAX_INPUT_QUEUE = 30  # Input frames beyond this are dropped, oldest first, so a flooding client can't pile them up
+    MAX_MOUSE = 2.0  # The furthest the mouse can move in one frame, from one edge of the window to the other
 
     def __init__(self, pid, name=None, protocol=None):
         super().__init__(name=name)
@@ -45,6 +50,14 @@ class Player (PhysicalObject):
         self.head_swivel = 0.0
         self.head_pitch = 0.0
         self.mouse_dirty = False
+        # Set when something else has moved us this tick, so our state goes out even if we didn't move ourselves.
+        self.teleported = False
+        self.grenades = 0
+        self.missiles = 0
+        # Input frames waiting to be applied, one per tick, as (seq, bits, mouse x, mouse y).
+        self.inputs = collections.deque(maxlen=self.MAX_INPUT_QUEUE)
+        # Sequence number of the last input frame applied, so clients know which of their predictions to replay.
+        self.input_seq = 0
         self.reposition_head()
 
     def reposition_head(self):
@@ -58,20 +71,24 @@ class Player (PhysicalObject):
         self.camera.look_at(self.floater)
 
     def setup(self, world):
-        self.body.add_shape(BulletBoxShape(Vec3(1.0, 1.0, 1.5)))
+        self.body.add_shape(assets.shape(('box', 1.0, 1.0, 1.5), lambda: BulletBoxShape(Vec3(1.0, 1.0, 1.5))))
         """
         geom = head.find_all_matches('**/+GeomNode').get_path(0).node().get_geom(0)
         shape = BulletConvexHullShape()
         shape.add_geom(geom)
         self.body.add_shape(shape, TransformState.make_pos(0, 0, 1.0))
         """
-        head = world.load_model('models/walker-head')
+        head = world.load_model('models/walker-head', prepare=self.prepare_head)
+        if head:
+            head.reparent_to(self.head)
+
+    @staticmethod
+    def prepare_head(head):
         head.find('Walker.Head.Main').set_color(1, 0, 0, 1)
         head.find('Walker.Head.Glass').set_color(0.7, 0.7, 1, 0.3)
         head.find('Walker.Head.Tubes').set_color(0.4, 0.4, 0.4, 1)
         head.set_color(1, 0, 0, 1)
         head.set_scale(2.0)
-        head.reparent_to(self.head)
 
     def serialize(self):
         data = super().serialize()
@@ -87,28 +104,98 @@ class Player (PhysicalObject):
             'head_hpr': self.head.get_hpr(),
         }
 
-    def set_state(self, state, fluid=True):
-        if fluid:
-            timestep = 1.0 / 30.0  # TODO: adjust based on latency?
-            Parallel(
-                LerpPosHprInterval(self.node, timestep, state['pos'], state['hpr']),
-                LerpHprInterval(self.head, timestep, state['head_hpr']),
-            ).start()
-            """
-            if self.camera:
-                Parallel(
-                    LerpPosHprInterval(self.node, 1.0 / 30.0, state['pos'], state['hpr']),
-                    LerpPosHprInterval(self.camera, 1.0 / 30.0, pos, state['hpr']),
-                ).start()
-            else:
-            """
-        else:
-            super().set_state(state, fluid=False)
-            self.head.set_hpr(state['head_hpr'])
+    def set_state(self, state):
+        super().set_state(state)
+        self.head.set_hpr(state['head_hpr'])
 
     def send(self, cmd, **args):
         self.protocol.send(cmd, **args)
 
+    def write(self, data):
+        self.protocol.write(data)
+
+    def get_movement(self):
+        """
+        Movement state not covered by get_state, which a client needs to replay its own inputs from this point.
+        """
+        return {
+            'seq': self.input_seq,
+            'velocity': self.velocity,
+            'resting': self.resting,
+            'motor_power': self.motor_power,
+            'turn_power': self.turn_power,
+        }
+
+    def set_movement(self, movement):
+        self.input_seq = movement['seq']
+        self.velocity = Vec3(movement['velocity'])
+        self.resting = movement['resting']
+        self.motor_power = movement['motor_power']
+        self.turn_power = movement['turn_power']
+
+    @classmethod
+    def input_bits(cls, commands):
+        bits = 0
+        for cmd in commands:
+            bits |= cls.INPUT_BITS[cmd]
+        return bits
+
+    def set_motion(self, bits):
+        for cmd in self.motion:
+            self.motion[cmd] = bool(bits & self.INPUT_BITS[cmd])
+
+    @classmethod
+    def check_input(cls, frame):
+        """
+        Returns a client's input frame in the form `next_input` expects, with the mouse movement clamped, or None if
+        it isn't one.
+        """
+        if not isinstance(frame, (tuple, list)) or len(frame) != 4:
+            return None
+        seq, bits, x, y = frame
+        # The sequence number goes back to the client, so it has to fit in a msgpack int.
+        if not isinstance(seq, int) or not 0 <= seq < 2 ** 63 or not isinstance(bits, int) or not 0 <= bits < 2 ** 8:
+            return None
+        # Comparing rather than using math.isfinite, which can't take ints too big to be floats.
+        if not all(isinstance(v, (int, float)) and -math.inf < v < math.inf for v in (x, y)):
+            return None
+        return (seq, bits, float(max(min(x, cls.MAX_MOUSE), -cls.MAX_MOUSE)),
+                float(max(min(y, cls.MAX_MOUSE), -cls.MAX_MOUSE)))
+
+    def queue_input(self, frame):
+        self.inputs.append(frame)
+
+    def next_input(self):
+        """
+        Applies the next queued input frame. If the client has got ahead, the extra frames are folded into this one.
+        """
+        if not self.inputs:
+            return
+        seq, bits, x, y = self.inputs.popleft()
+        while len(self.inputs) > self.MAX_INPUT_BACKLOG:
+            seq, more, dx, dy = self.inputs.popleft()
+            bits = more | (bits & self.INPUT_BITS['center'])
+            x += dx
+            y += dy
+        self.input_seq = seq
+        self.set_motion(bits)
+        if bits & self.INPUT_BITS['center']:
+            self.input('center', True)
+        if x or y:
+            self.mouse(x, y)
+
+    def teleport(self, pos, heading=None):
+        self.node.set_pos(pos)
+        if heading is not None:
+            self.node.set_h(heading)
+        self.velocity = Vec3(0, 0, 0)
+        self.resting = False
+        self.teleported = True
+
+    def collect(self, grenades=0, missiles=0):
+        self.grenades += grenades
+        self.missiles += missiles
+
     def input(self, cmd, pressed):
         if cmd in self.motion:
             self.motion[cmd] = pressed
@@ -125,8 +212,11 @@ class Player (PhysicalObject):
         self.reposition_head()
 
     def update(self, world, dt):
-        dirty = self.mouse_dirty
-        old_pos = self.node.get_pos()
+        self.next_input()
+        dirty = self.mouse_dirty or self.teleported
+        self.teleported = False
+        start_pos = self.node.get_pos()
+        old_pos = start_pos
         h = self.node.get_h()
         new_velocity = self.velocity + (world.gravity * dt)
 
@@ -229,7 +319,7 @@ class Player (PhysicalObject):
         self.node.set_pos(new_pos)
         self.velocity = new_velocity
         self.mouse_dirty = False
-        if old_pos != new_pos:
+        if start_pos != new_pos:
             dirty = True
 
         return dirty
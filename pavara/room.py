@@ -0,0 +1,302 @@
+from panda3d.core import Vec3
+
+from .constants import TIMESTEP
+from .interest import InterestManager
+from .loading import SlicedLoader
+from .mapcache import MapDownload, is_map_hash
+from .metrics import TickMetrics
+from .player import Player
+from .snapshot import SnapshotEncoder
+from .world import World
+
+import logging
+import random
+import time
+
+
+logger = logging.getLogger('pavara.room')
+
+
+class Room:
+    """
+    One match: a world, the players in it, and the loop that ticks it. A host (the server, or a worker process) runs
+    any number of rooms, each on its own tick schedule, and provides the event loop, the map cache, and a way to
+    encode and write messages to players.
+    """
+
+    MAX_STEPS = 4  # The most ticks to run in one go when catching up, before dropping time.
+    REPORT_INTERVAL = 10.0  # seconds
+
+    def __init__(self, host, name):
+        self.host = host
+        self.name = name
+        self.loop = host.loop
+        self.timestep = TIMESTEP
+        self.next_tick = None
+        self.last_report = None
+        # The handle for the next scheduled tick, so the loop can be stopped when the room closes.
+        self.ticker = None
+        self.metrics = TickMetrics()
+        self.downloads = {}
+        # The SlicedLoader for the map being loaded, if any. Loads run a slice at a time so the loop stays responsive.
+        self.loading = None
+        # World ids of the objects that came from the map, which clients create from their own copy of it.
+        self.map_hash = None
+        self.map_ids = set()
+        self.world = None
+        self.players = {}
+        self.snapshots = SnapshotEncoder()
+        self.interest = InterestManager()
+
+    def __repr__(self):
+        return 'Room({!r})'.format(self.name)
+
+    def join(self, player):
+        self.players[player.pid] = player
+        logger.debug('Player %s joined room %s as %s', player.pid, self.name, player.name)
+        player.send('self', pid=player.pid)
+        self.broadcast('joined', name=player.name, pid=player.pid)
+        if self.world:
+            self.snapshots.reset(player.pid, self.world.frame)
+            player.send('loaded', **self.loaded_args())
+
+    def leave(self, player):
+        logger.debug('Player %s left room %s', player.pid, self.name)
+        if self.world:
+            self.world.remove(player)
+        self.snapshots.forget(player.pid)
+        # Abandon any map we were fetching from them.
+        for digest, download in list(self.downloads.items()):
+            if download.send == player.send:
+                del self.downloads[digest]
+        del self.players[player.pid]
+
+    def handle(self, player, cmd, **args):
+        func = getattr(self, 'handle_{}'.format(cmd), None)
+        if func:
+            func(player, **args)
+        else:
+            logger.error('Unknown command from Player %s: %s', player.pid, cmd)
+
+    def close(self):
+        """
+        Stops ticking and loading, once the last player has left.
+        """
+        logger.debug('Closing room %s', self.name)
+        if self.ticker:
+            self.ticker.cancel()
+            self.ticker = None
+        if self.loading:
+            self.loading.cancel()
+            self.loading = None
+        self.downloads = {}
+
+    def start_game_loop(self):
+        self.next_tick = self.last_report = self.loop.time()
+        self.game_loop()
+
+    def game_loop(self):
+        """
+        Runs every tick that is due (up to MAX_STEPS) against absolute deadlines, so slow ticks are caught up rather
+        than stretching the tick rate, then sends state once.
+        """
+        start = time.perf_counter()
+        now = self.loop.time()
+        steps = 0
+        while self.next_tick <= now and steps < self.MAX_STEPS:
+            self.step()
+            self.next_tick += self.timestep
+            steps += 1
+        if self.next_tick <= now:
+            dropped = int((now - self.next_tick) / self.timestep) + 1
+            logger.warning('Room %s overloaded, dropping %d ticks', self.name, dropped)
+            self.metrics.dropped += dropped
+            self.next_tick += dropped * self.timestep
+        self.metrics.steps += steps
+        self.send_state()
+        self.metrics.add('tick', time.perf_counter() - start)
+        self.metrics.commit()
+        if now - self.last_report >= self.REPORT_INTERVAL:
+            logger.debug('Tick metrics for room %s:\n%s', self.name, self.metrics.report())
+            self.metrics.reset()
+            self.last_report = now
+        self.ticker = self.loop.call_at(self.next_tick, self.game_loop)
+
+    def step(self):
+        for cmd, args in self.world.tick(self.timestep):
+            if cmd == 'state':
+                self.snapshots.update(args['frame'], args['state'])
+                continue
+            if cmd == 'removed':
+                for world_id in args['world_ids']:
+                    self.snapshots.remove(world_id)
+            self.broadcast(cmd, **args)
+
+    def send_state(self):
+        for pid, player in self.players.items():
+            state = self.snapshots.get_delta(pid, self.interest.relevant(self.world, player, self.world.frame))
+            if not state:
+                continue
+            if player.world_id in state:
+                # Players get their own movement state too, to reconcile their predictions against.
+                data = self.encode('state', frame=self.world.frame, state=state, movement=player.get_movement())
+            else:
+                data = self.encode('state', frame=self.world.frame, state=state)
+            with self.metrics.timer('flush'):
+                self.host.write_state(player, data)
+
+    def encode(self, cmd, **args):
+        with self.metrics.timer('serialize'):
+            return self.host.encode(cmd, **args)
+
+    def broadcast(self, cmd, exclude=None, **args):
+        """
+        Packs the message once and writes the same buffer to every player in the room, skipping any pids in `exclude`.
+        """
+        data = self.encode(cmd, **args)
+        with self.metrics.timer('flush'):
+            self.host.write([player for pid, player in self.players.items() if not exclude or pid not in exclude], data)
+
+    def loaded_args(self):
+        """
+        Arguments for a 'loaded' message: the map's hash, and only the objects that didn't come from the map. Static
+        map objects never move, so their state is left out too.
+        """
+        objects = self.world.objects
+        return {
+            'map': self.map_hash,
+            'frame': self.world.frame,
+            'objects': [obj.serialize() for world_id, obj in objects.items() if world_id not in self.map_ids],
+            'removed': [world_id for world_id in self.map_ids if world_id not in objects],
+            'state': {world_id: obj.get_state() for world_id, obj in objects.items()
+                      if world_id not in self.map_ids or not getattr(obj, 'static', False)},
+        }
+
+    def load(self, digest, steps, player):
+        """
+        Starts loading a map, given a generator that returns its CompiledMap (see `MapCache.find_steps`). Progress is
+        broadcast as 'loading' messages, then 'loaded' when the world is ready. If the map turns out not to be
+        available locally, it is fetched from `player` instead.
+        """
+        self.loading = SlicedLoader(
+            self.loop,
+            self.load_steps(steps),
+            progress=lambda stage, done, total: self.broadcast('loading', map=digest, stage=stage, done=done,
+                                                               total=total),
+            finished=lambda result: self.loaded(digest, result, player),
+            failed=self.load_failed,
+        )
+        self.loading.start()
+
+    def load_steps(self, steps):
+        compiled = yield from steps
+        if compiled is None:
+            return None
+        # Nobody looks at the server's worlds, so they skip models, geometry, and lights.
+        world = World(metrics=self.metrics, headless=True)
+        m = yield from compiled.load_steps(world)
+        return compiled, world, m
+
+    def loaded(self, digest, result, player):
+        self.loading = None
+        if result is None:
+            if player.pid not in self.players:
+                return
+            # Fetch the map from the player who asked for it.
+            download = self.downloads[digest] = MapDownload(digest, player.send)
+            download.start()
+            return
+        compiled, self.world, m = result
+        self.map_hash = compiled.hash
+        self.map_ids = set(self.world.objects)
+        logger.debug('Player %s loaded map "%s" in room %s', player.pid, m.name, self.name)
+        for pid in self.players:
+            self.snapshots.reset(pid, self.world.frame)
+        self.broadcast('loaded', **self.loaded_args())
+
+    def load_failed(self, error):
+        self.loading = None
+
+    def handle_load(self, player, **args):
+        if not is_map_hash(args.get('map')):
+            logger.error('Player %s asked for a bad map hash: %r', player.pid, args.get('map'))
+            return
+        if self.world or self.loading or args['map'] in self.downloads:
+            return
+        self.load(args['map'], self.host.maps.find_steps(args['map']), player)
+
+    def handle_map_chunk(self, player, **args):
+        download = self.downloads.get(args['map'])
+        if not download:
+            return
+        try:
+            xml = download.received(args['index'], args['count'], args['data'])
+        except ValueError as e:
+            logger.error('Player %s sent a bad map: %s', player.pid, e)
+            del self.downloads[args['map']]
+            return
+        if xml:
+            del self.downloads[args['map']]
+            if not self.world and not self.loading:
+                self.load(args['map'], self.host.maps.get_steps(xml), player)
+
+    def handle_ready(self, player, **args):
+        if not self.world or player.world_id in self.world.objects:
+            return
+        self.world.attach(player)
+        pos, heading = random.choice(self.world.incarnators)
+        player.node.set_pos(pos)
+        player.node.set_h(heading)
+        self.world.moved(player)
+        self.broadcast('attached', objects=[player.serialize()], state={
+            player.world_id: player.get_state(),
+        })
+
+    def handle_start(self, player, **args):
+        if self.world and self.world.frame == 0:
+            players = {}
+#            incarnators = random.sample(self.world.incarnators, len(self.players))
+#            for idx, pid in enumerate(self.players):
+#                players[pid] = self.players[pid].get_state(incarn=incarnators[idx])
+            self.start_game_loop()
+            self.broadcast('started', players=players)
+
+    def handle_input(self, player, **args):
+        frame = Player.check_input(args.get('frame'))
+        if frame is None:
+            logger.error('Player %s sent a bad input frame: %r', player.pid, args.get('frame'))
+            return
+        player.queue_input(frame)
+
+    def handle_fire(self, player, **args):
+        if not self.world or player.world_id not in self.world.objects:
+            return
+        from .weapons import Grenade
+        floater_pos = player.floater.get_pos(self.world.node)
+        direction = floater_pos - (player.node.get_pos() + Vec3(0, 0, -1.0))
+        direction.normalize()
+        grenade = self.world.spawn(Grenade)
+        grenade.node.set_pos(floater_pos)
+        grenade.body.apply_central_impulse(direction * 150.0)
+        grenade.body.set_angular_velocity(Vec3(10.0, 0, 0))
+        self.world.attach(grenade)
+        # TODO: need a better system for sending attached/removed events from the world
+        self.broadcast('attached', objects=[grenade.serialize()], state={
+            grenade.world_id: grenade.get_state(),
+        })
+
+    def handle_explode(self, player, **args):
+        if not self.world:
+            return
+        for obj in self.world.objects.values():
+            if hasattr(obj, 'mass') and obj.mass > 0:
+                obj.body.set_active(True)
+                obj.body.apply_central_impulse(Vec3(
+                    random.uniform(-5000, 5000),
+                    random.uniform(-5000, 5000),
+                    random.uniform(-5000, 5000),
+                ))
+                self.world.wake(obj)
+
+    def handle_ack(self, player, **args):
+        self.snapshots.ack(player.pid, args['frame'])
@@ -1,60 +1,112 @@
-from panda3d.core import Vec3, loadPrcFileData
+from panda3d.core import loadPrcFileData
 
 from .log import configure_logging
-from .maps import load_map
-from .network import MsgpackProtocol
+from .mapcache import DEFAULT_CACHE_DIR, MapCache
+from .network import DatagramProtocol, MsgpackProtocol, TrafficCounter, pack
 from .player import Player
-from .world import World
+from .room import Room
+from .workers import WorkerLink, WorkerRoom
 
 import argparse
 import asyncio
 import logging
 import os
-import random
+import secrets
 
 
 logger = logging.getLogger('pavara.server')
 
 
 class Server:
+    """
+    Accepts connections and routes each player's messages to the room they joined. Messages that aren't about a match
+    (joining, pings, map requests) are handled here; everything else goes to the player's room. Rooms run in this
+    process, or with `--workers`, are spread across that many worker processes so matches can use every core.
+    """
+
+    DEFAULT_ROOM = 'default'
+    REPORT_INTERVAL = 10.0  # seconds
 
     def __init__(self, opts):
         super().__init__()
         self.opts = opts
-        self.timestep = 1.0 / 30.0
         self.loop = asyncio.get_event_loop()
-        self.map = None
-        self.world = None
+        self.maps = MapCache(opts.map_cache)
+        self.maps.scan('maps')
         self.players = {}
+        self.rooms = {}
+        # The room each player is in, by pid. Players are only in a room once they have joined one.
+        self.player_rooms = {}
+        self.workers = [WorkerLink(self, index) for index in range(getattr(opts, 'workers', 0))]
+        self.traffic = TrafficCounter()
+        self.datagrams = None
+        # UDP addresses of players that have said hello on the datagram channel, and the reverse.
+        self.peers = {}
+        self.peer_pids = {}
+        # The secret each connection says hello with, so nobody else can claim its datagram channel. Pids aren't
+        # secret, since rooms tell everyone who joined.
+        self.tokens = {}
 
     def connected(self, proto):
         logger.debug('Player %s connected', proto.pid)
         self.players[proto.pid] = Player(proto.pid, protocol=proto)
+        token = secrets.token_hex(16)
+        self.tokens[token] = proto.pid
+        proto.send('token', token=token)
 
     def disconnected(self, proto):
         logger.debug('Player %s disconnected', proto.pid)
-        if self.world:
-            self.world.remove(self.players[proto.pid])
+        self.leave(self.players[proto.pid])
+        addr = self.peers.pop(proto.pid, None)
+        if addr:
+            del self.peer_pids[addr]
+            self.datagrams.forget(addr)
+        self.tokens = {token: pid for token, pid in self.tokens.items() if pid != proto.pid}
         del self.players[proto.pid]
 
     def handle(self, proto, cmd, **args):
         # logger.debug('Message received from Player %s: %s', proto.pid, cmd)
         player = self.players[proto.pid]
+        room = self.player_rooms.get(proto.pid)
         func = getattr(self, 'handle_{}'.format(cmd), None)
         if func:
             func(player, **args)
+        elif room:
+            room.handle(player, cmd, **args)
         else:
-            logger.error('Unknown command from Player %s: %s', proto.pid, cmd)
-
-    def game_loop(self):
-        for cmd, args in self.world.tick(self.timestep):
-            self.broadcast(cmd, **args)
-        self.loop.call_later(self.timestep, self.game_loop)
+            logger.error('Player %s sent %s before joining a room', proto.pid, cmd)
+
+    # DatagramProtocol delegate
+
+    def datagram_received(self, channel, addr, cmd, **args):
+        # Source addresses are easily forged, so the datagram channel is only trusted with acks.
+        if cmd == 'hello':
+            token = args.get('token')
+            player = self.players.get(self.tokens.get(token)) if isinstance(token, str) else None
+            if player and player.pid not in self.peers and addr not in self.peer_pids:
+                logger.debug('Player %s opened datagram channel from %s:%s', player.pid, *addr[:2])
+                self.peers[player.pid] = addr
+                self.peer_pids[addr] = player.pid
+                player.send('welcome')
+        elif cmd == 'ack' and addr in self.peer_pids and isinstance(args.get('frame'), int):
+            self.handle(self.players[self.peer_pids[addr]].protocol, cmd, frame=args['frame'])
+
+    def report_loop(self):
+        logger.debug('%d rooms, %d players, %d encodes, %d bytes sent in the last %ds', len(self.rooms),
+                     len(self.players), self.traffic.encodes, self.traffic.bytes, self.REPORT_INTERVAL)
+        self.traffic.tick()
+        self.loop.call_later(self.REPORT_INTERVAL, self.report_loop)
 
     def run(self, run_loop=True):
+        for worker in self.workers:
+            worker.start()
         logger.debug('Listening on %s:%s', self.opts.addr, self.opts.port)
-        coro = self.loop.create_server(lambda: MsgpackProtocol(self), self.opts.addr, self.opts.port)
+        coro = self.loop.create_server(lambda: MsgpackProtocol(self, counter=self.traffic), self.opts.addr, self.opts.port)
         self.loop.run_until_complete(coro)
+        coro = self.loop.create_datagram_endpoint(lambda: DatagramProtocol(self, loss=self.opts.loss, counter=self.traffic),
+                                                  local_addr=(self.opts.addr, self.opts.port))
+        _, self.datagrams = self.loop.run_until_complete(coro)
+        self.loop.call_later(self.REPORT_INTERVAL, self.report_loop)
         if run_loop:
             try:
                 self.loop.run_forever()
@@ -63,80 +115,77 @@ class Server:
             finally:
                 self.loop.close()
 
-    def broadcast(self, cmd, **args):
-        for pid, player in self.players.items():
-            player.send(cmd, **args)
+    def encode(self, cmd, **args):
+        self.traffic.encodes += 1
+        return pack(cmd, **args)
+
+    def write(self, players, data):
+        for player in players:
+            player.write(data)
+
+    def write_state(self, player, data):
+        """
+        Sends a packed state message over the player's datagram channel if they have one, or their connection if not.
+        States too big to be reassembled at the other end go over the connection too, or they would never be acked,
+        and the deltas against the last ack would only grow.
+        """
+        if player.pid in self.peers:
+            datagrams = self.datagrams.fragment(data)
+            if len(datagrams) <= self.datagrams.MAX_FRAGMENTS:
+                self.datagrams.write(datagrams, self.peers[player.pid])
+                return
+        player.write(data)
+
+    def leave(self, player):
+        """
+        Takes a player out of their room, if they are in one. Rooms close once everyone has left.
+        """
+        room = self.player_rooms.pop(player.pid, None)
+        if not room:
+            return
+        room.leave(player)
+        if not room.players:
+            room.close()
+            del self.rooms[room.name]
+
+    def open_room(self, name):
+        logger.debug('Opening room %s', name)
+        if not self.workers:
+            return Room(self, name)
+        # New rooms go to whichever worker is running the fewest.
+        return WorkerRoom(min(self.workers, key=lambda worker: len(worker.rooms)), name)
+
+    def room_closed(self, room):
+        """
+        Forgets a room that closed on its own (e.g. because its worker died), leaving its players free to join another.
+        """
+        for pid in room.players:
+            self.player_rooms.pop(pid, None)
+        self.rooms.pop(room.name, None)
 
     def handle_join(self, player, **args):
-        player.name = args.get('name', player.name)
-        logger.debug('Player %s joined as %s', player.pid, player.name)
-        player.send('self', pid=player.pid)
-        self.broadcast('joined', name=player.name, pid=player.pid)
-        if self.world:
-            player.send('loaded', objects=self.world.serialize(), state=self.world.get_state())
-
-    def handle_load(self, player, **args):
-        if self.world:
+        name = args.get('room') or self.DEFAULT_ROOM
+        current = self.player_rooms.get(player.pid)
+        if current and current.name == name:
             return
-        from direct.showbase.Loader import Loader
-        loader = Loader(self)
-        self.world = World(loader=loader)
-        m = load_map(args['xml'], self.world)
-        logger.debug('Player %s loaded map "%s"', player.pid, m.name)
-        self.broadcast('loaded', objects=self.world.serialize())
-
-    def handle_ready(self, player, **args):
-        if player.world_id in self.world.objects:
-            return
-        self.world.attach(player)
-        pos, heading = random.choice(self.world.incarnators)
-        player.node.set_pos(pos)
-        player.node.set_h(heading)
-        self.broadcast('attached', objects=[player.serialize()], state={
-            player.world_id: player.get_state(),
-        })
-
-    def handle_start(self, player, **args):
-        if self.world and self.world.frame == 0:
-            players = {}
-#            incarnators = random.sample(self.world.incarnators, len(self.players))
-#            for idx, pid in enumerate(self.players):
-#                players[pid] = self.players[pid].get_state(incarn=incarnators[idx])
-            self.game_loop()
-            self.broadcast('started', players=players)
-
-    def handle_input(self, player, **args):
-        player.input(args['input'], args['pressed'])
-
-    def handle_mouse(self, player, **args):
-        player.mouse(args['x'], args['y'])
-
-    def handle_fire(self, player, **args):
-        from .weapons import Grenade
-        floater_pos = player.floater.get_pos(self.world.node)
-        direction = floater_pos - (player.node.get_pos() + Vec3(0, 0, -1.0))
-        direction.normalize()
-        grenade = Grenade()
-        grenade.node.set_pos(floater_pos)
-        grenade.body.apply_central_impulse(direction * 150.0)
-        grenade.body.set_angular_velocity(Vec3(10.0, 0, 0))
-        self.world.attach(grenade)
-        # TODO: need a better system for sending attached/removed events from the world
-        self.broadcast('attached', objects=[grenade.serialize()], state={
-            grenade.world_id: grenade.get_state(),
-        })
-
-    def handle_explode(self, player, **args):
-        if not self.world:
-            return
-        for obj in self.world.objects.values():
-            if hasattr(obj, 'mass') and obj.mass > 0:
-                obj.body.set_active(True)
-                obj.body.apply_central_impulse(Vec3(
-                    random.uniform(-5000, 5000),
-                    random.uniform(-5000, 5000),
-                    random.uniform(-5000, 5000),
-                ))
+        if current:
+            self.leave(player)
+            # The old player was attached to another world, so start over with a fresh one.
+            player = self.players[player.pid] = Player(player.pid, protocol=player.protocol)
+        player.name = args.get('name', player.name)
+        room = self.rooms.get(name)
+        if not room:
+            room = self.rooms[name] = self.open_room(name)
+        self.player_rooms[player.pid] = room
+        room.join(player)
+
+    def handle_map_request(self, player, **args):
+        chunk = self.maps.chunk(args.get('map'), args.get('index'))
+        if chunk:
+            count, data = chunk
+            player.send('map_chunk', map=args['map'], index=args['index'], count=count, data=data)
+        else:
+            logger.error('Player %s requested unknown map %r', player.pid, args.get('map'))
 
     def handle_ping(self, player, **args):
         player.send('pong')
@@ -154,5 +203,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Pavara server')
     parser.add_argument('-a', '--addr', default='0.0.0.0')
     parser.add_argument('-p', '--port', type=int, default=19567)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--map-cache', default=DEFAULT_CACHE_DIR)
+    parser.add_argument('-w', '--workers', type=int, default=0)
     server = Server(parser.parse_args())
     server.run()
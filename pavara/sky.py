@@ -1,9 +1,12 @@
-from panda3d.core import Shader
+from panda3d.core import LRotationf, Shader
+import numpy
 
 from .constants import DEFAULT_GROUND_COLOR, DEFAULT_HORIZON_COLOR, DEFAULT_HORIZON_SCALE, DEFAULT_SKY_COLOR
-from .geom import GeomBuilder
+from .geom import GeomBuilder, to_cartesian
 from .objects import GameObject
 
+import math
+
 
 class Sky (GameObject):
 
@@ -40,6 +43,11 @@ class Sky (GameObject):
         self.node.set_shader_input('gradientHeight', self.gradient, 0, 0, 0)
         self.node.set_pos(world.camera, 0, 9999, 0)
 
+    def removed(self, world):
+        if self.node:
+            self.node.remove_node()
+            self.node = None
+
     def set_sky_color(self, color):
         self.color = color
         if self.node:
@@ -54,3 +62,118 @@ class Sky (GameObject):
         self.ground = color
         if self.node:
             self.node.set_shader_input('groundColor', self.ground)
+
+
+class Celestial (GameObject):
+    """
+    A sun or moon: a directional light shining from `azimuth` and `elevation` (in degrees), optionally drawn in the sky
+    as a ball `size` across. The first one a map adds replaces the world's default lights.
+    """
+
+    DISTANCE = 1000.0 * 255.0 / 256.0
+    SAMPLES = 16
+    PLANES = 8
+
+    def __init__(self, azimuth, elevation, color=None, intensity=1.0, size=30.0, visible=False, name=None):
+        super().__init__(name=name)
+        self.azimuth = azimuth
+        self.elevation = elevation
+        self.color = color or (1, 1, 1, 1)
+        self.intensity = intensity
+        self.size = size
+        self.visible = visible
+        self.light = None
+        self.node = None
+
+    def serialize(self):
+        data = super().serialize()
+        data.update({
+            'azimuth': self.azimuth,
+            'elevation': self.elevation,
+            'color': self.color,
+            'intensity': self.intensity,
+            'size': self.size,
+            'visible': self.visible,
+        })
+        return data
+
+    def attached(self, world):
+        world.clear_default_lights()
+        azimuth = math.radians(self.azimuth)
+        elevation = math.radians(self.elevation)
+        self.light = world.add_celestial(azimuth, elevation, self.color, self.intensity, self.size)
+        if not self.visible or not world.camera:
+            return
+        center = to_cartesian(azimuth, elevation, self.DISTANCE)
+        radius = self.size / 2.0
+        builder = GeomBuilder('celestial')
+        builder.add_dome(self.color, center, radius, self.SAMPLES, self.PLANES)
+        builder.add_dome(self.color, center, radius, self.SAMPLES, self.PLANES, rot=LRotationf(0, 180, 0))
+        # Follow the camera around, but not its rotation, so it looks infinitely far away.
+        self.node = world.camera.attach_new_node(builder.get_geom_node())
+        self.node.set_compass()
+        self.node.set_light_off()
+
+    def removed(self, world):
+        if self.light:
+            world.remove_celestial(self.light)
+            self.light = None
+        if self.node:
+            self.node.remove_node()
+            self.node = None
+
+
+class Starfield (GameObject):
+    """
+    `count` stars scattered over the sky from a random `seed`, between `min_size` and `max_size`. In "realistic" mode
+    most stars are small and faint, with a few bright ones; otherwise sizes are spread evenly.
+    """
+
+    DISTANCE = 900.0
+    SCALE = 2.0  # Units across per unit of star size.
+
+    def __init__(self, seed=0, count=100, min_size=1.0, max_size=1.0, mode=None, name=None):
+        super().__init__(name=name)
+        self.seed = seed
+        self.count = count
+        self.min_size = min_size
+        self.max_size = max_size
+        self.mode = mode
+        self.node = None
+
+    def serialize(self):
+        data = super().serialize()
+        data.update({
+            'seed': self.seed,
+            'count': self.count,
+            'min_size': self.min_size,
+            'max_size': self.max_size,
+            'mode': self.mode,
+        })
+        return data
+
+    def attached(self, world):
+        if not world.camera or not self.count:
+            return
+        random = numpy.random.RandomState(self.seed % (2 ** 32))
+        azimuths = random.uniform(0.0, math.pi * 2, self.count)
+        # Evenly spread over the upper half of the sphere.
+        elevations = numpy.arcsin(random.uniform(0.0, 1.0, self.count))
+        magnitudes = random.uniform(0.0, 1.0, self.count)
+        if self.mode == 'realistic':
+            magnitudes = magnitudes ** 3
+            brightness = 0.4 + magnitudes * 0.6
+        else:
+            brightness = numpy.ones(self.count)
+        sizes = self.min_size + (self.max_size - self.min_size) * magnitudes
+        colors = numpy.stack((brightness, brightness, brightness, numpy.ones(self.count)), axis=1)
+        centers = to_cartesian(azimuths, elevations, self.DISTANCE)
+        builder = GeomBuilder('starfield').add_billboards(colors, centers, sizes * self.SCALE / 2.0)
+        self.node = world.camera.attach_new_node(builder.get_geom_node())
+        self.node.set_compass()
+        self.node.set_light_off()
+
+    def removed(self, world):
+        if self.node:
+            self.node.remove_node()
+            self.node = None
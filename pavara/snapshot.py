@@ -0,0 +1,155 @@
+from panda3d.core import Vec3
+
+
+# Fixed-point scales used to quantize state fields on the wire (1cm positions, 0.1 degree angles).
+FIELD_SCALES = {
+    'pos': 100.0,
+    'hpr': 10.0,
+    'head_hpr': 10.0,
+}
+DEFAULT_SCALE = 100.0
+
+
+def quantize(state):
+    quantized = {}
+    for field, value in state.items():
+        scale = FIELD_SCALES.get(field, DEFAULT_SCALE)
+        quantized[field] = tuple(int(round(v * scale)) for v in value)
+    return quantized
+
+
+def dequantize(state):
+    values = {}
+    for field, value in state.items():
+        scale = FIELD_SCALES.get(field, DEFAULT_SCALE)
+        values[field] = Vec3(*(v / scale for v in value))
+    return values
+
+
+class SnapshotEncoder:
+    """
+    Server-side record of the quantized state of every object that has changed, stamped with the frame each field
+    last changed in. Each client acknowledges the frames it applies, so for every object we know the last frame the
+    client is guaranteed to have it as of, and only need to send the fields stamped after that.
+    """
+
+    KEYFRAME_INTERVAL = 90  # frames between full resyncs for each client
+    PENDING_LIMIT = 300  # unacknowledged frames to remember per client
+
+    def __init__(self):
+        self.frame = 0
+        self.fields = {}
+        self.clients = {}
+
+    def update(self, frame, states):
+        self.frame = frame
+        for world_id, state in states.items():
+            fields = self.fields.setdefault(world_id, {})
+            for name, value in quantize(state).items():
+                current = fields.get(name)
+                if current is None or current[1] != value:
+                    fields[name] = (frame, value)
+
+    def remove(self, world_id):
+        self.fields.pop(world_id, None)
+        for client in self.clients.values():
+            client.acked.pop(world_id, None)
+
+    def reset(self, pid, frame):
+        """
+        Called when a client has been sent the full world state as of `frame`.
+        """
+        self.clients[pid] = ClientSnapshot(frame)
+
+    def ack(self, pid, frame):
+        if pid in self.clients:
+            self.clients[pid].ack(frame)
+
+    def forget(self, pid):
+        self.clients.pop(pid, None)
+
+    def get_delta(self, pid, relevant=None):
+        """
+        Returns the changed fields the given client needs, limited to the `relevant` world ids if given. Clients that
+        have not been reset yet have no world to apply state to, and get None.
+        """
+        client = self.clients.get(pid)
+        if client is None:
+            return None
+        keyframe = self.frame - client.keyframe >= self.KEYFRAME_INTERVAL
+        if keyframe:
+            client.keyframe = self.frame
+            relevant = None
+        world_ids = self.fields.keys() if relevant is None else [w for w in relevant if w in self.fields]
+        state = {}
+        for world_id in world_ids:
+            base = -1 if keyframe else client.acked.get(world_id, client.base)
+            changed = {name: value for name, (frame, value) in self.fields[world_id].items() if frame > base}
+            if changed:
+                state[world_id] = changed
+        if state:
+            client.sent(self.frame, list(state), self.PENDING_LIMIT)
+        return state
+
+
+class ClientSnapshot:
+    """
+    Tracks, for one client, the last acknowledged frame of each object and which objects went out in each frame that
+    has not been acknowledged yet.
+    """
+
+    def __init__(self, frame):
+        self.base = frame
+        self.keyframe = frame
+        self.acked = {}
+        self.pending = {}
+
+    def sent(self, frame, world_ids, limit):
+        self.pending[frame] = world_ids
+        if len(self.pending) > limit:
+            del self.pending[min(self.pending)]
+
+    def ack(self, frame):
+        world_ids = self.pending.pop(frame, None)
+        if world_ids is None:
+            return
+        # Anything sent before this frame and still pending was lost (or will be dropped as stale by the client).
+        for stale in [f for f in self.pending if f < frame]:
+            del self.pending[stale]
+        for world_id in world_ids:
+            if frame > self.acked.get(world_id, self.base):
+                self.acked[world_id] = frame
+
+
+class SnapshotDecoder:
+    """
+    Client-side mirror of the object states, rebuilt from deltas sent by a SnapshotEncoder.
+    """
+
+    def __init__(self, frame=0, states=None):
+        self.frame = frame
+        self.states = {}
+        if states:
+            self.seed(states)
+
+    def seed(self, states):
+        for world_id, state in states.items():
+            if state:
+                self.states.setdefault(world_id, {}).update(state)
+
+    def remove(self, world_id):
+        self.states.pop(world_id, None)
+
+    def apply(self, frame, state):
+        """
+        Applies a delta, returning the full states of the objects it touched, or None if the delta is stale.
+        """
+        if frame <= self.frame:
+            return None
+        self.frame = frame
+        changed = {}
+        for world_id, fields in state.items():
+            current = self.states.setdefault(world_id, {})
+            current.update(dequantize(fields))
+            changed[world_id] = current
+        return changed
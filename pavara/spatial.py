@@ -0,0 +1,128 @@
+from panda3d.core import Point3
+
+import heapq
+import itertools
+import math
+
+
+class SpatialGrid:
+    """
+    Uniform grid of objects bucketed by position, so finding objects near a point only visits nearby cells.
+    Objects must be moved explicitly when their position changes.
+    """
+
+    def __init__(self, cell_size=16.0):
+        self.cell_size = float(cell_size)
+        self.cells = {}
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, obj):
+        return obj in self.positions
+
+    def cell(self, pos):
+        return (
+            int(math.floor(pos[0] / self.cell_size)),
+            int(math.floor(pos[1] / self.cell_size)),
+            int(math.floor(pos[2] / self.cell_size)),
+        )
+
+    def insert(self, obj, pos):
+        if obj in self.positions:
+            self.move(obj, pos)
+            return
+        cell = self.cell(pos)
+        self.cells.setdefault(cell, set()).add(obj)
+        self.positions[obj] = (Point3(pos), cell)
+
+    def move(self, obj, pos):
+        _, old_cell = self.positions[obj]
+        cell = self.cell(pos)
+        if cell != old_cell:
+            self._discard(obj, old_cell)
+            self.cells.setdefault(cell, set()).add(obj)
+        self.positions[obj] = (Point3(pos), cell)
+
+    def remove(self, obj):
+        if obj in self.positions:
+            _, cell = self.positions.pop(obj)
+            self._discard(obj, cell)
+
+    def _discard(self, obj, cell):
+        bucket = self.cells[cell]
+        bucket.discard(obj)
+        if not bucket:
+            del self.cells[cell]
+
+    def _range(self, lo, hi):
+        lo_cell = self.cell(lo)
+        hi_cell = self.cell(hi)
+        for x in range(lo_cell[0], hi_cell[0] + 1):
+            for y in range(lo_cell[1], hi_cell[1] + 1):
+                for z in range(lo_cell[2], hi_cell[2] + 1):
+                    bucket = self.cells.get((x, y, z))
+                    if bucket:
+                        yield from bucket
+
+    def query_aabb(self, lo, hi):
+        """
+        Yields every object whose position is inside the box from `lo` to `hi`.
+        """
+        for obj in self._range(lo, hi):
+            pos = self.positions[obj][0]
+            if lo[0] <= pos.x <= hi[0] and lo[1] <= pos.y <= hi[1] and lo[2] <= pos.z <= hi[2]:
+                yield obj
+
+    def query_radius(self, pos, radius):
+        """
+        Yields (object, distance) for every object within `radius` of `pos`.
+        """
+        pos = Point3(pos)
+        extent = Point3(radius, radius, radius)
+        for obj in self._range(pos - extent, pos + extent):
+            d = (self.positions[obj][0] - pos).length()
+            if d <= radius:
+                yield obj, d
+
+    def _ring(self, center, r):
+        """
+        Cells whose Chebyshev distance from `center` is exactly `r`.
+        """
+        if r == 0:
+            yield center
+            return
+        cx, cy, cz = center
+        for dx, dy in itertools.product(range(-r, r + 1), repeat=2):
+            if abs(dx) == r or abs(dy) == r:
+                for dz in range(-r, r + 1):
+                    yield (cx + dx, cy + dy, cz + dz)
+            else:
+                yield (cx + dx, cy + dy, cz - r)
+                yield (cx + dx, cy + dy, cz + r)
+
+    def nearest(self, pos, count=1):
+        """
+        Returns up to `count` (object, distance) tuples closest to `pos`, nearest first.
+        """
+        pos = Point3(pos)
+        center = self.cell(pos)
+        best = []
+        limit = max((max(abs(c[0] - center[0]), abs(c[1] - center[1]), abs(c[2] - center[2])) for c in self.cells),
+                    default=-1)
+        r = 0
+        while r <= limit:
+            # Anything in ring r is at least (r - 1) cells away, so stop once that can't beat what we have.
+            if len(best) == count and (r - 1) * self.cell_size > -best[0][0]:
+                break
+            for cell in self._ring(center, r):
+                for obj in self.cells.get(cell, ()):
+                    d = (self.positions[obj][0] - pos).length()
+                    entry = (-d, id(obj), obj)
+                    if len(best) < count:
+                        heapq.heappush(best, entry)
+                    elif d < -best[0][0]:
+                        heapq.heapreplace(best, entry)
+            r += 1
+        return [(obj, -d) for d, _, obj in sorted(best, reverse=True)]
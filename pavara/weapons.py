@@ -1,28 +1,35 @@
 from panda3d.bullet import BulletSphereShape
 
+from .assets import assets
+from .items import Trigger
 from .objects import SolidObject
 
 
 class Grenade (SolidObject):
+    always_relevant = True
+    poolable = True
 
     def __init__(self, mass=5.0, name=None):
         super().__init__(mass=mass, name=name)
 
     def setup(self, world):
-        self.body.add_shape(BulletSphereShape(0.2))
-        model = world.load_model('models/grenade')
+        self.body.add_shape(assets.shape(('sphere', 0.2), lambda: BulletSphereShape(0.2)))
+        model = world.load_model('models/grenade', prepare=self.prepare_model)
         if model:
-            model.find('grenade.red').set_color(1, 0, 0, 1)
-            model.find('grenade.yellow').set_color(1, 1, 0, 1)
             model.reparent_to(self.node)
 
-    def update(self, world, dt):
-        result = world.physics.contact_test(self.body)
-        if result.get_num_contacts() > 0:
-            nade_pos = self.node.get_pos()
-            for obj, distance in world.find(nade_pos, 10.0):
-                if not isinstance(obj, Grenade):
-                    obj.hit(nade_pos, distance)
-            world.remove(self)
-            return False
-        return self.body.is_active()
+    @staticmethod
+    def prepare_model(model):
+        model.find('grenade.red').set_color(1, 0, 0, 1)
+        model.find('grenade.yellow').set_color(1, 1, 0, 1)
+
+    def collision(self, world, obj):
+        # Triggers (like the teleporter under the map that catches anything falling off it) aren't anything to hit.
+        if isinstance(obj, Trigger):
+            return
+        nade_pos = self.node.get_pos()
+        for target, distance in world.find(nade_pos, 10.0):
+            if not isinstance(target, Grenade):
+                target.hit(nade_pos, distance)
+                world.wake(target)
+        world.remove(self)
@@ -0,0 +1,226 @@
+from panda3d.core import loadPrcFileData
+
+from .log import configure_logging
+from .mapcache import MapCache
+from .network import MsgpackProtocol, pack
+from .player import Player
+from .room import Room
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import socket
+
+
+logger = logging.getLogger('pavara.workers')
+
+
+class LinkProtocol (MsgpackProtocol):
+    """
+    A MsgpackProtocol over one end of a local socket pair, between the front-end server and a worker process.
+    """
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.delegate.connected(self)
+
+
+class RemoteConnection:
+    """
+    Stands in for a player's MsgpackProtocol inside a worker, passing everything written to it back to the front end,
+    which owns the actual connection.
+    """
+
+    def __init__(self, worker, pid):
+        self.worker = worker
+        self.pid = pid
+
+    def send(self, cmd, **args):
+        self.write(pack(cmd, **args))
+
+    def write(self, data):
+        self.worker.write_pids([self.pid], data)
+
+
+class Worker:
+    """
+    Runs rooms in a child process, for the front-end server at the other end of `sock`. Messages from players arrive
+    already decoded, and everything sent to players goes back encoded, so the front end never unpacks or repacks them.
+    Broadcasts are encoded and sent back once, and the front end writes the same buffer to every player.
+    """
+
+    def __init__(self, opts, sock):
+        self.opts = opts
+        self.sock = sock
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.maps = MapCache(opts.map_cache)
+        self.maps.scan('maps')
+        self.link = None
+        self.players = {}
+        self.rooms = {}
+        self.player_rooms = {}
+
+    def run(self):
+        coro = self.loop.create_connection(lambda: LinkProtocol(self), sock=self.sock)
+        self.loop.run_until_complete(coro)
+        try:
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.loop.close()
+
+    # MsgpackProtocol delegate
+
+    def connected(self, proto):
+        self.link = proto
+
+    def disconnected(self, proto):
+        # The front end has gone away, so there is nobody left to play.
+        self.loop.stop()
+
+    def handle(self, proto, cmd, **args):
+        func = getattr(self, 'handle_{}'.format(cmd), None)
+        if func:
+            func(**args)
+        else:
+            logger.error('Unknown command from front end: %s', cmd)
+
+    # Room host
+
+    def encode(self, cmd, **args):
+        return pack(cmd, **args)
+
+    def write(self, players, data):
+        self.write_pids([player.pid for player in players], data)
+
+    def write_pids(self, pids, data):
+        if pids and self.link:
+            self.link.send('write', pids=pids, data=data)
+
+    def write_state(self, player, data):
+        if self.link:
+            self.link.send('state', pid=player.pid, data=data)
+
+    def handle_join(self, pid, name, room):
+        player = self.players[pid] = Player(pid, name=name, protocol=RemoteConnection(self, pid))
+        if room not in self.rooms:
+            self.rooms[room] = Room(self, room)
+        self.player_rooms[pid] = self.rooms[room]
+        self.rooms[room].join(player)
+
+    def handle_leave(self, pid):
+        player = self.players.pop(pid)
+        room = self.player_rooms.pop(pid)
+        room.leave(player)
+        if not room.players:
+            room.close()
+            del self.rooms[room.name]
+
+    def handle_message(self, pid, command, args):
+        self.player_rooms[pid].handle(self.players[pid], command, **args)
+
+
+class WorkerLink:
+    """
+    The front end's side of a worker process: it starts the process, and writes whatever the worker sends back to the
+    players it is meant for.
+    """
+
+    def __init__(self, server, index):
+        self.server = server
+        self.index = index
+        self.process = None
+        self.link = None
+        self.rooms = {}
+
+    def start(self):
+        ours, theirs = socket.socketpair()
+        # Spawned rather than forked, so the worker gets a clean Panda3D and event loop of its own.
+        context = multiprocessing.get_context('spawn')
+        self.process = context.Process(target=run_worker, args=(self.server.opts, theirs),
+                                       name='pavara-worker-{}'.format(self.index), daemon=True)
+        self.process.start()
+        theirs.close()
+        coro = self.server.loop.create_connection(lambda: LinkProtocol(self), sock=ours)
+        self.server.loop.run_until_complete(coro)
+
+    def send(self, cmd, **args):
+        self.link.send(cmd, **args)
+
+    # MsgpackProtocol delegate
+
+    def connected(self, proto):
+        self.link = proto
+
+    def disconnected(self, proto):
+        logger.error('Worker %d went away, closing its %d rooms', self.index, len(self.rooms))
+        self.link = None
+        for room in list(self.rooms.values()):
+            self.server.room_closed(room)
+        self.rooms = {}
+
+    def handle(self, proto, cmd, **args):
+        func = getattr(self, 'handle_{}'.format(cmd), None)
+        if func:
+            func(**args)
+        else:
+            logger.error('Unknown command from worker %d: %s', self.index, cmd)
+
+    def handle_write(self, pids, data):
+        for pid in pids:
+            player = self.server.players.get(pid)
+            if player:
+                player.write(data)
+
+    def handle_state(self, pid, data):
+        player = self.server.players.get(pid)
+        if player:
+            self.server.write_state(player, data)
+
+
+class WorkerRoom:
+    """
+    The front end's handle on a room running in a worker process. It only keeps track of who is in the room, and
+    forwards their messages to the worker.
+    """
+
+    def __init__(self, worker, name):
+        self.worker = worker
+        self.name = name
+        self.players = {}
+        worker.rooms[name] = self
+
+    def __repr__(self):
+        return 'WorkerRoom({!r}, worker={})'.format(self.name, self.worker.index)
+
+    def join(self, player):
+        self.players[player.pid] = player
+        self.worker.send('join', pid=player.pid, name=player.name, room=self.name)
+
+    def leave(self, player):
+        del self.players[player.pid]
+        if self.worker.link:
+            self.worker.send('leave', pid=player.pid)
+
+    def close(self):
+        self.worker.rooms.pop(self.name, None)
+
+    def handle(self, player, cmd, **args):
+        if self.worker.link:
+            self.worker.send('message', pid=player.pid, command=cmd, args=args)
+
+
+def run_worker(opts, sock):
+    """
+    Entry point for worker processes. Spawned processes don't run the server's `__main__` block, so they configure
+    logging and Panda3D the same way here.
+    """
+    configure_logging()
+    loadPrcFileData('', """
+        window-type none
+        model-path %s
+    """ % os.getcwd())
+    Worker(opts, sock).run()
@@ -1,31 +1,78 @@
 from panda3d.bullet import BulletDebugNode, BulletWorld
-from panda3d.core import AmbientLight, DirectionalLight, NodePath, TransparencyAttrib, Vec3
+from panda3d.core import AmbientLight, DirectionalLight, NodePath, PythonCallbackObject, TransparencyAttrib, Vec3
 
+from .assets import assets
+from .batching import StaticCollision, StaticGeometry, attach_collision, attach_geometry
 from .constants import DEFAULT_AMBIENT_COLOR
 from .geom import to_cartesian
-from .objects import GameObject, PhysicalObject
+from .metrics import TickMetrics
+from .objects import GameObject, PhysicalObject, SolidObject
+from .spatial import SpatialGrid
 
+import collections
 import math
 
 
+def contact_added(data):
+    """
+    Bullet's contact-added callback, which it calls during a physics step for each new point of contact involving a
+    body with `notify_collisions` set. There is only one for the whole process, so it hands contacts to whichever world
+    is stepping.
+    """
+    if World.stepping:
+        World.stepping.contact_added(data.get_node0(), data.get_node1())
+
+
+# Every world sets this same callback, since swapping in another while Bullet holds the first one crashes.
+contact_callback = PythonCallbackObject(contact_added)
+
+
 class World:
+    POOL_SIZE = 64  # Removed objects of each poolable class to keep around for reuse.
+    stepping = None  # The world whose physics step is running, for `contact_added`.
 
-    def __init__(self, loader=None, camera=None, debug=False):
+    def __init__(self, loader=None, camera=None, debug=False, metrics=None, batching=True, headless=False,
+                 pool_size=POOL_SIZE):
         self.loader = loader
         self.camera = camera
+        # Headless worlds (on dedicated servers) only simulate: objects build their collision shapes, but no models,
+        # geometry, or lights.
+        self.headless = headless
+        self.static_geometry = StaticGeometry() if batching and not headless else None
+        self.static_collision = None
+        self.static_baked = False
+        self.metrics = metrics or TickMetrics()
         self.physics = BulletWorld()
         self.gravity = Vec3(0, 0, -30.0)
         self.physics.set_gravity(self.gravity)
+        self.physics.set_contact_added_callback(contact_callback)
         self.objects = {}
+        # The objects that get `update` calls each tick, and the idle ones among the rest that Bullet could wake up.
+        self.active = {}
+        self.sleeping = {}
+        # The objects that get `collision` calls, and the pairs of bodies that touched them in the last physics step,
+        # waiting for `dispatch_collisions`.
+        self.listeners = {}
+        self.collisions = collections.deque()
+        # The objects that wake idle ghosts they overlap (see `PhysicalObject.wakes_overlaps`).
+        self.wakers = {}
+        self.index = SpatialGrid()
+        self.always_relevant = set()
         self.frame = 0
         self.last_object_id = 0
         self.incarnators = []
+        # Parked objects waiting to be reused by `spawn`, by class.
+        self.pool_size = pool_size
+        self.pools = {}
         self.debug = debug
         self.setup()
         self.commands = []
 
     def setup(self):
         self.node = NodePath('world')
+        self.default_lights = []
+        if self.headless:
+            return
         self.node.set_transparency(TransparencyAttrib.MAlpha)
         if self.debug:
             d = BulletDebugNode('Debug')
@@ -41,30 +88,101 @@ class World:
         alight.set_color(DEFAULT_AMBIENT_COLOR)
         self.ambient = self.node.attach_new_node(alight)
         self.node.set_light(self.ambient)
-        # Default directional lights
-        self.add_celestial(math.radians(20), math.radians(45), (1, 1, 1, 1), 0.4, 30.0)
-        self.add_celestial(math.radians(200), math.radians(20), (1, 1, 1, 1), 0.3, 30.0)
+        # Default directional lights, until the map adds its own.
+        self.default_lights = [
+            self.add_celestial(math.radians(20), math.radians(45), (1, 1, 1, 1), 0.4, 30.0),
+            self.add_celestial(math.radians(200), math.radians(20), (1, 1, 1, 1), 0.3, 30.0),
+        ]
 
     def tick(self, dt):
         self.frame += 1
-        self.physics.doPhysics(dt, 4, 1.0 / 60.0)
+        with self.metrics.timer('physics'):
+            World.stepping = self
+            try:
+                self.physics.doPhysics(dt, 4, 1.0 / 60.0)
+            finally:
+                World.stepping = None
+        with self.metrics.timer('collisions'):
+            self.dispatch_collisions()
+        # Bullet wakes bodies up when something bumps into them, without telling us.
+        for obj in [obj for obj in self.sleeping.values() if obj.body.is_active()]:
+            self.wake(obj)
+        # Nor does it have anything to wake ghosts with, so things that walk into them do it.
+        for waker in list(self.wakers.values()):
+            for node in waker.body.get_overlapping_nodes():
+                obj = node.get_python_tag('object')
+                if obj is not None and obj.world_id not in self.active and self.objects.get(obj.world_id) is obj and \
+                        not isinstance(obj, SolidObject):
+                    self.wake(obj)
         state = {}
-        for obj in list(self.objects.values()):
-            if obj.update(self, dt):
-                state[obj.world_id] = obj.get_state()
+        with self.metrics.timer('update'):
+            # Updates can attach and remove objects, so go over a copy.
+            for obj in list(self.active.values()):
+                if obj.update(self, dt):
+                    state[obj.world_id] = obj.get_state()
+                    if obj in self.index:
+                        self.moved(obj)
+                if obj.idle() and self.active.get(obj.world_id) is obj:
+                    self.rest(obj)
         for cmd, args in self.commands:
             yield cmd, args
         if state:
             yield 'state', {'frame': self.frame, 'state': state}
         self.commands = []
 
+    def contact_added(self, node0, node1):
+        # Bodies can't be added or removed mid-step, so collisions are held until the step is over.
+        self.collisions.append((node0, node1))
+
+    def dispatch_collisions(self):
+        """
+        Calls `collision` on the listening objects of each pair of bodies that made a new contact in the last physics
+        step, once per pair. Bullet only reports contacts involving listeners' bodies, so this costs nothing until
+        something hits one. Bodies that don't belong to an object (like the combined static body) are passed as None.
+        """
+        seen = set()
+        while self.collisions:
+            nodes = self.collisions.popleft()
+            if nodes in seen:
+                continue
+            seen.add(nodes)
+            pair = (nodes[0].get_python_tag('object'), nodes[1].get_python_tag('object'))
+            for obj, other in (pair, pair[::-1]):
+                # An earlier collision this step may have removed either of them.
+                if self.listening(obj) and (other is None or self.objects.get(other.world_id) is other):
+                    obj.collision(self, other)
+
+    def listening(self, obj):
+        return obj is not None and self.listeners.get(obj.world_id) is obj
+
     def attach(self, obj):
-        obj.setup(self)
+        recycled = obj.parked
+        if recycled:
+            obj.unpark(self)
+        else:
+            obj.setup(self)
         if obj.world_id is None:
             self.last_object_id += 1
             obj.world_id = self.last_object_id
+        elif isinstance(obj.world_id, int):
+            # Keep generated ids clear of ones assigned elsewhere, e.g. in a compiled map.
+            self.last_object_id = max(self.last_object_id, obj.world_id)
         self.objects[obj.world_id] = obj
-        obj.attached(self)
+        if not recycled:
+            obj.attached(self)
+        self.active[obj.world_id] = obj
+        if obj.idle():
+            self.rest(obj)
+        if obj.listens():
+            self.listeners[obj.world_id] = obj
+            if isinstance(obj, PhysicalObject):
+                obj.body.notify_collisions(True)
+        if isinstance(obj, PhysicalObject):
+            self.index.insert(obj, obj.node.get_pos())
+            if obj.wakes_overlaps:
+                self.wakers[obj.world_id] = obj
+        if obj.always_relevant:
+            self.always_relevant.add(obj.world_id)
         if self.frame > 0 and False:
             self.commands.append(('attached', {
                 'objects': [obj.serialize()],
@@ -74,40 +192,146 @@ class World:
             }))
         return obj
 
+    def batch(self, obj, pos):
+        """
+        Takes the geometry of a static object into the merged static geometry, returning False if the object should
+        draw itself instead. Batched geometry is attached by `flush_static`. Headless worlds take everything, and draw
+        nothing.
+        """
+        if self.headless:
+            return True
+        if self.static_baked and obj.static:
+            return True
+        if self.static_geometry is None or not obj.static:
+            return False
+        self.static_geometry.add(obj, pos)
+        return True
+
+    def combine_static(self):
+        """
+        Starts merging the collision shapes of static objects attached from now on into one compound body.
+        """
+        if self.static_collision is None:
+            self.static_collision = StaticCollision()
+
+    def combine(self, obj, make_shape, transform):
+        """
+        Takes a static object's collision shape (built by calling `make_shape`, and placed in world space by
+        `transform`) into the combined static body, returning False if the object should add the shape to its own body
+        instead. The combined body is attached by `flush_static`.
+        """
+        if self.static_baked and obj.static:
+            return True
+        if self.static_collision is None or not obj.static:
+            return False
+        self.static_collision.add(make_shape(), transform)
+        return True
+
+    def load_static(self, geometry, collision):
+        """
+        Attaches static geometry and collision baked by `StaticGeometry.bake` and `StaticCollision.bake`. Static objects
+        attached until the next `flush_static` are assumed to be part of them, so they neither draw themselves nor
+        add their own shapes.
+        """
+        if not self.headless:
+            attach_geometry(self.node, geometry)
+        if collision:
+            attach_collision(self, collision)
+        self.static_baked = True
+
+    def flush_static(self):
+        self.static_baked = False
+        if self.static_geometry is not None:
+            self.static_geometry.flush(self.node)
+        if self.static_collision is not None:
+            self.static_collision.flush(self)
+
     def remove(self, world_id):
         if isinstance(world_id, GameObject):
             world_id = world_id.world_id
         if world_id not in self.objects:
             return
-        self.objects[world_id].removed(self)
-        del self.objects[world_id]
+        obj = self.objects.pop(world_id)
+        self.active.pop(world_id, None)
+        self.sleeping.pop(world_id, None)
+        self.listeners.pop(world_id, None)
+        self.wakers.pop(world_id, None)
+        self.index.remove(obj)
+        self.always_relevant.discard(world_id)
+        if obj.poolable and len(self.pools.setdefault(type(obj), [])) < self.pool_size:
+            # Parked objects keep their world id, so ids get reused rather than growing without bound.
+            obj.park(self)
+            self.pools[type(obj)].append(obj)
+            # Its contacts from before it was parked mustn't reach it if it is spawned again during this dispatch.
+            self.collisions = collections.deque(nodes for nodes in self.collisions if obj.body not in nodes)
+        else:
+            obj.removed(self)
         if self.frame > 0:
             self.commands.append(('removed', {'world_ids': [world_id]}))
 
+    def wake(self, obj):
+        """
+        Puts an idle object back on the list of objects to update, e.g. after giving it a push. Bodies Bullet wakes up
+        on its own are noticed after each physics step.
+        """
+        self.sleeping.pop(obj.world_id, None)
+        self.active[obj.world_id] = obj
+
+    def rest(self, obj):
+        """
+        Stops updating an idle object until it is woken up again.
+        """
+        del self.active[obj.world_id]
+        if isinstance(obj, SolidObject) and not obj.static:
+            self.sleeping[obj.world_id] = obj
+
+    def spawn(self, cls):
+        """
+        Returns an object of a poolable class, reusing a parked one if there is one, ready to be placed and attached.
+        """
+        pool = self.pools.get(cls)
+        if pool:
+            return pool.pop()
+        return cls()
+
+    def moved(self, obj):
+        """
+        Updates the spatial index after a physical object has been moved outside of `tick`.
+        """
+        self.index.move(obj, obj.node.get_pos())
+
     def find(self, pos, radius):
-        for obj in self.objects.values():
-            if isinstance(obj, PhysicalObject):
-                d = (obj.node.get_pos() - pos).length()
-                if d <= radius:
-                    yield obj, d
+        return self.index.query_radius(pos, radius)
+
+    def find_box(self, lo, hi):
+        return self.index.query_aabb(lo, hi)
+
+    def nearest(self, pos, count=1):
+        return self.index.nearest(pos, count)
 
     def add_incarnator(self, pos, heading):
         self.incarnators.append((pos, heading))
 
-    def load_model(self, name):
+    def load_model(self, name, prepare=None):
         """
-        Stubbed out here in case we want to allow adding/loading custom models from map XML.
+        Stubbed out here in case we want to allow adding/loading custom models from map XML. Returns an instance of the
+        model (see `AssetRegistry.model`), or None if there is no loader, or the world is headless.
         """
-        return self.loader.load_model(name) if self.loader else None
+        if not self.loader or self.headless:
+            return None
+        return assets.model(self.loader, name, prepare)
 
     def serialize(self):
         return {world_id: obj.serialize() for world_id, obj in self.objects.items()}
 
-    def deserialize(self, data):
+    def deserialize(self, data, combine_static=False):
         self.node.remove_node()
         self.setup()
+        if combine_static:
+            self.combine_static()
         for world_id, obj_data in data.items():
             self.attach(GameObject.deserialize(obj_data))
+        self.flush_static()
 
     def get_state(self):
         states = {}
@@ -115,11 +339,18 @@ class World:
             states[world_id] = obj.get_state()
         return states
 
-    def set_state(self, states, fluid=True):
+    def set_state(self, states):
         for world_id, state in states.items():
-            self.objects[world_id].set_state(state, fluid=fluid)
+            if world_id in self.objects:
+                self.objects[world_id].set_state(state)
 
     def add_celestial(self, azimuth, elevation, color, intensity, radius):
+        """
+        Adds a directional light shining from `azimuth` and `elevation` (in radians), returning its NodePath, or None
+        if it has no intensity.
+        """
+        if self.headless:
+            return None
         location = Vec3(to_cartesian(azimuth, elevation, 1000.0 * 255.0 / 256.0))
         if intensity:
             dlight = DirectionalLight('celestial')
@@ -127,3 +358,18 @@ class World:
             node = self.node.attach_new_node(dlight)
             node.look_at(*(location * -1))
             self.node.set_light(node)
+            return node
+        return None
+
+    def remove_celestial(self, node):
+        self.node.clear_light(node)
+        node.remove_node()
+
+    def clear_default_lights(self):
+        """
+        Removes the default directional lights, for maps that light themselves.
+        """
+        for node in self.default_lights:
+            if node:
+                self.remove_celestial(node)
+        self.default_lights = []
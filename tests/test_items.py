@@ -0,0 +1,25 @@
+from panda3d.core import Point3
+
+from pavara.items import Teleporter
+from pavara.player import Player
+from pavara.world import World
+
+
+def run(world, ticks):
+    for _ in range(ticks):
+        list(world.tick(1.0 / 30.0))
+
+
+def test_linked_teleporters_do_not_bounce_back():
+    # Either teleporter may update first, so check both orders.
+    for groups in (('a', 'b'), ('b', 'a')):
+        world = World(headless=True)
+        teleporters = {group: Teleporter(Point3(x, 0, 0), group=group, destination='b' if group == 'a' else 'a')
+                       for group, x in zip(groups, (0, 50))}
+        for teleporter in teleporters.values():
+            world.attach(teleporter)
+        player = world.attach(Player('p'))
+        player.teleport(teleporters['a'].location)
+        world.moved(player)
+        run(world, 10)
+        assert player.node.get_pos().x == teleporters['b'].location.x
@@ -0,0 +1,87 @@
+from pavara.network import DatagramProtocol, pack
+
+import random
+
+
+class Recorder:
+
+    def __init__(self):
+        self.received = []
+
+    def datagram_received(self, channel, addr, cmd, **args):
+        self.received.append((addr, cmd, args))
+
+
+def receiver():
+    recorder = Recorder()
+    return DatagramProtocol(recorder), recorder
+
+
+def fragments(sender, size=5000, **args):
+    return sender.fragment(pack('state', blob=b'x' * size, **args))
+
+
+def test_out_of_order_fragments_reassemble():
+    sender = DatagramProtocol(None)
+    protocol, recorder = receiver()
+    datagrams = fragments(sender, n=1)
+    assert len(datagrams) > 2
+    random.Random(1).shuffle(datagrams)
+    for datagram in datagrams:
+        protocol.datagram_received(datagram, 'a')
+    assert recorder.received == [('a', 'state', {'blob': b'x' * 5000, 'n': 1})]
+    assert not protocol.fragments
+
+
+def test_lost_fragments_are_superseded():
+    sender = DatagramProtocol(None)
+    protocol, recorder = receiver()
+    first = fragments(sender, n=1)
+    second = fragments(sender, n=2)
+    for datagram in first[1:] + second:
+        protocol.datagram_received(datagram, 'a')
+    # The rest of the first message turns up too late to matter.
+    protocol.datagram_received(first[0], 'a')
+    assert [args['n'] for _, _, args in recorder.received] == [2]
+
+
+def test_older_messages_are_dropped():
+    sender = DatagramProtocol(None)
+    protocol, recorder = receiver()
+    first = sender.fragment(pack('ack', frame=1))
+    second = sender.fragment(pack('ack', frame=2))
+    for datagram in second + first:
+        protocol.datagram_received(datagram, 'a')
+    # Each address has its own sequence.
+    for datagram in first:
+        protocol.datagram_received(datagram, 'b')
+    assert [(addr, args['frame']) for addr, _, args in recorder.received] == [('a', 2), ('b', 1)]
+
+
+def test_malformed_datagrams_are_dropped():
+    protocol, recorder = receiver()
+    header = DatagramProtocol.HEADER
+    protocol.datagram_received(b'\x00', 'a')
+    protocol.datagram_received(header.pack(1, 0, DatagramProtocol.MAX_FRAGMENTS + 1) + b'x', 'a')
+    protocol.datagram_received(header.pack(2, 0, 2) + b'x', 'a')
+    protocol.datagram_received(header.pack(2, 5, 9) + b'x', 'a')  # A different count for the same message.
+    protocol.datagram_received(header.pack(3, 0, 1) + b'\xc1', 'a')
+    protocol.datagram_received(header.pack(4, 0, 1) + pack('ack')[:-1], 'a')
+    assert recorder.received == []
+    protocol.datagram_received(header.pack(5, 0, 1) + pack('ack', frame=5), 'a')
+    assert recorder.received == [('a', 'ack', {'frame': 5})]
+
+
+def test_quiet_addresses_expire():
+    sender = DatagramProtocol(None)
+    protocol, recorder = receiver()
+    for addr in range(10):
+        protocol.datagram_received(fragments(sender)[0], addr)
+    assert len(protocol.delivered) == 0 and len(protocol.fragments) == 10
+    for addr in protocol.heard:
+        protocol.heard[addr] -= DatagramProtocol.EXPIRY * 2
+    protocol.next_expiry = 0
+    protocol.datagram_received(sender.fragment(pack('ack', frame=1))[0], 'new')
+    assert set(protocol.heard) == {'new'}
+    assert set(protocol.delivered) == {'new'}
+    assert not protocol.fragments
@@ -0,0 +1,75 @@
+from panda3d.core import Vec3
+
+from pavara.snapshot import SnapshotDecoder, SnapshotEncoder
+
+
+def state(x, h=0.0):
+    return {'pos': Vec3(x, 2.0, 3.0), 'hpr': Vec3(h, 0.0, 0.0)}
+
+
+def assert_close(decoded, expected):
+    for name, value in expected.items():
+        assert (decoded[name] - value).length() < 0.01
+
+
+def test_delta_round_trips_against_acked_baseline():
+    encoder = SnapshotEncoder()
+    encoder.reset('p', 0)
+    decoder = SnapshotDecoder(0)
+    encoder.update(1, {1: state(1.0), 2: state(5.0)})
+    delta = encoder.get_delta('p')
+    assert set(delta) == {1, 2}
+    decoder.apply(1, delta)
+    encoder.ack('p', 1)
+    # Only what changed since the acknowledged frame goes out.
+    encoder.update(2, {1: state(1.5), 2: state(5.0)})
+    delta = encoder.get_delta('p')
+    assert delta == {1: {'pos': (150, 200, 300)}}
+    decoder.apply(2, delta)
+    assert_close(decoder.states[1], state(1.5))
+    assert_close(decoder.states[2], state(5.0))
+
+
+def test_unacked_changes_are_resent():
+    encoder = SnapshotEncoder()
+    encoder.reset('p', 0)
+    decoder = SnapshotDecoder(0)
+    encoder.update(1, {1: state(1.0)})
+    encoder.get_delta('p')  # Lost on the way.
+    encoder.update(2, {1: state(1.0, h=90.0)})
+    delta = encoder.get_delta('p')
+    assert set(delta[1]) == {'pos', 'hpr'}
+    decoder.apply(2, delta)
+    assert_close(decoder.states[1], state(1.0, h=90.0))
+    # A late ack for the lost frame doesn't count once a newer one is acked.
+    encoder.ack('p', 2)
+    encoder.ack('p', 1)
+    encoder.update(3, {1: state(1.0, h=90.0)})
+    assert encoder.get_delta('p') == {}
+
+
+def test_stale_deltas_are_ignored():
+    decoder = SnapshotDecoder(0)
+    assert decoder.apply(2, {1: {'pos': (100, 0, 0)}}) is not None
+    assert decoder.apply(1, {1: {'pos': (900, 0, 0)}}) is None
+    assert_close(decoder.states[1], {'pos': Vec3(1.0, 0.0, 0.0)})
+
+
+def test_keyframes_resend_everything():
+    encoder = SnapshotEncoder()
+    encoder.reset('p', 0)
+    encoder.update(1, {1: state(1.0), 2: state(2.0)})
+    encoder.get_delta('p', relevant=[1])
+    encoder.ack('p', 1)
+    frame = SnapshotEncoder.KEYFRAME_INTERVAL
+    encoder.update(frame, {})
+    # Irrelevant objects are left out until the keyframe, which ignores both relevance and acks.
+    delta = encoder.get_delta('p', relevant=[1])
+    assert set(delta) == {1, 2}
+    assert set(delta[1]) == {'pos', 'hpr'}
+
+
+def test_clients_without_a_world_get_nothing():
+    encoder = SnapshotEncoder()
+    encoder.update(1, {1: state(1.0)})
+    assert encoder.get_delta('p') is None
@@ -0,0 +1,78 @@
+from panda3d.core import Point3
+
+from pavara.spatial import SpatialGrid
+
+import random
+
+
+def scatter(seed=0, count=300, extent=100.0):
+    rand = random.Random(seed)
+    grid = SpatialGrid(cell_size=8.0)
+    positions = {}
+    for obj in range(count):
+        pos = Point3(*(rand.uniform(-extent, extent) for _ in range(3)))
+        grid.insert(obj, pos)
+        positions[obj] = pos
+    return rand, grid, positions
+
+
+def within(positions, center, radius):
+    return {obj for obj, pos in positions.items() if (pos - center).length() <= radius}
+
+
+def test_radius_matches_brute_force():
+    rand, grid, positions = scatter()
+    for _ in range(50):
+        center = Point3(*(rand.uniform(-120.0, 120.0) for _ in range(3)))
+        radius = rand.uniform(0.0, 40.0)
+        found = dict(grid.query_radius(center, radius))
+        assert set(found) == within(positions, center, radius)
+        for obj, d in found.items():
+            assert abs(d - (positions[obj] - center).length()) < 1e-4
+
+
+def test_box_matches_brute_force():
+    rand, grid, positions = scatter(seed=1)
+    for _ in range(50):
+        corners = [Point3(*(rand.uniform(-120.0, 120.0) for _ in range(3))) for _ in range(2)]
+        lo = Point3(*(min(a, b) for a, b in zip(*corners)))
+        hi = Point3(*(max(a, b) for a, b in zip(*corners)))
+        expected = {obj for obj, p in positions.items() if all(lo[i] <= p[i] <= hi[i] for i in range(3))}
+        assert set(grid.query_aabb(lo, hi)) == expected
+
+
+def test_nearest_matches_brute_force():
+    rand, grid, positions = scatter(seed=2)
+    for _ in range(50):
+        # Include points well outside the populated area, where the search has to widen a long way.
+        center = Point3(*(rand.uniform(-300.0, 300.0) for _ in range(3)))
+        count = rand.randint(1, 10)
+        expected = sorted((pos - center).length() for pos in positions.values())[:count]
+        found = grid.nearest(center, count)
+        assert len(found) == count
+        for (obj, d), distance in zip(found, expected):
+            assert abs(d - distance) < 1e-4
+            assert abs(d - (positions[obj] - center).length()) < 1e-4
+
+
+def test_queries_follow_moves_and_removals():
+    rand, grid, positions = scatter(seed=3)
+    for obj in range(0, 300, 3):
+        positions[obj] = Point3(*(rand.uniform(-100.0, 100.0) for _ in range(3)))
+        grid.move(obj, positions[obj])
+    for obj in range(1, 300, 3):
+        del positions[obj]
+        grid.remove(obj)
+    assert len(grid) == len(positions)
+    center = Point3(10.0, -20.0, 5.0)
+    assert set(dict(grid.query_radius(center, 50.0))) == within(positions, center, 50.0)
+    nearest = min(positions, key=lambda obj: (positions[obj] - center).length())
+    assert grid.nearest(center)[0][0] == nearest
+
+
+def test_nearest_with_few_objects():
+    grid = SpatialGrid()
+    assert grid.nearest((0, 0, 0), 3) == []
+    grid.insert('a', (1000.0, 0.0, 0.0))
+    grid.insert('b', (-5.0, 0.0, 0.0))
+    assert [obj for obj, _ in grid.nearest((0, 0, 0), 3)] == ['b', 'a']